@@ -0,0 +1,176 @@
+import threading
+
+import numpy as np
+
+from pydub import AudioSegment
+
+##################
+# Audio Assembly #
+##################
+
+"""
+Putting clips together with NumPy instead of repeated AudioSegment
+operations, which copy the whole clip every time. Clips are converted once to
+a common format, then concatenated or overlaid into a preallocated array.
+Arrays are shaped (frames, channels). As in pydub, 8 bit samples are signed.
+
+Snippets convert what they render to the canonical format right away (and
+it's cached that way), so assembling and playing never has to convert.
+stats counts clips that were already canonical, clips converted at render
+time, and late conversions during assembly, which should stay at 0.
+"""
+
+dtypes = {1: np.int8, 2: np.int16, 4: np.int32}
+
+class Format():
+    def __init__(self, frame_rate, channels, sample_width):
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    @property
+    def dtype(self):
+        return dtypes[self.sample_width]
+
+    def __eq__(self, other):
+        return (self.frame_rate, self.channels, self.sample_width) == (other.frame_rate, other.channels, other.sample_width)
+
+    def __repr__(self):
+        return f'Format({self.frame_rate}, {self.channels}, {self.sample_width})'
+
+def get_format(clip):
+    return Format(clip.frame_rate, clip.channels, clip.sample_width)
+
+canonical = Format(22050, 1, 2) #Change before rendering anything
+
+stats = {'canonical': 0, 'converted': 0, 'late': 0}
+stats_lock = threading.Lock()
+
+def count(stat):
+    with stats_lock:
+        stats[stat] += 1
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+def add_stats(counts):
+    """
+    Add counts from another process, like a RenderPool worker
+    """
+    with stats_lock:
+        for key, val in counts.items():
+            stats[key] += val
+
+def to_canonical(clip):
+    """
+    Convert a freshly rendered clip to the canonical format
+    """
+    if clip is None: return None
+    if get_format(clip) == canonical:
+        count('canonical')
+        return clip
+    if len(clip.raw_data) == 0:
+        return to_segment(np.empty((0, canonical.channels)), canonical)
+    count('converted')
+    return clip.set_frame_rate(canonical.frame_rate).set_channels(canonical.channels).set_sample_width(canonical.sample_width)
+
+def common_format(clips):
+    """
+    The format pydub would end up with after combining the clips
+    """
+    return Format(
+        max(x.frame_rate for x in clips),
+        max(x.channels for x in clips),
+        max(x.sample_width for x in clips),
+        )
+
+def convert(clip, fmt):
+    """
+    Return clip in the given format. Does nothing if it's already there.
+    """
+    if get_format(clip) != fmt:
+        count('late')
+    return clip.set_frame_rate(fmt.frame_rate).set_channels(fmt.channels).set_sample_width(fmt.sample_width)
+
+def to_array(clip, fmt = None):
+    """
+    A read-only view of the samples of clip, converted to fmt first if given
+    """
+    if fmt is None:
+        fmt = get_format(clip)
+    else:
+        clip = convert(clip, fmt)
+    return np.frombuffer(clip.raw_data, dtype=fmt.dtype).reshape(-1, fmt.channels)
+
+def to_segment(data, fmt):
+    return AudioSegment(
+        data = np.ascontiguousarray(data, dtype=fmt.dtype).tobytes(),
+        frame_rate = fmt.frame_rate,
+        channels = fmt.channels,
+        sample_width = fmt.sample_width,
+        )
+
+def duration(data, fmt):
+    return len(data)/fmt.frame_rate
+
+def concatenate(arrays, fmt):
+    """
+    Join arrays that are already in fmt end to end with one allocation
+    """
+    total = sum(len(x) for x in arrays)
+    result = np.empty((total, fmt.channels), dtype=fmt.dtype)
+    idx = 0
+    for data in arrays:
+        result[idx:idx+len(data)] = data
+        idx += len(data)
+    return result
+
+def overlay(arrays, fmt):
+    """
+    Mix arrays that are already in fmt on top of each other, starting
+    together. The result is as long as the longest one and saturates like
+    pydub's overlay.
+    """
+    total = max(len(x) for x in arrays)
+    result = np.zeros((total, fmt.channels), dtype=np.int64)
+    for data in arrays:
+        result[:len(data)] += data
+    info = np.iinfo(fmt.dtype)
+    return np.clip(result, info.min, info.max).astype(fmt.dtype)
+
+def reverse(data):
+    return data[::-1]
+
+def truncate(data, seconds, fmt):
+    return data[:int(seconds*fmt.frame_rate)]
+
+def fade_out(data, fmt, to_gain = -120):
+    """
+    Fade linearly in amplitude from full volume to to_gain dB over the whole
+    array, like AudioSegment.fade_out over the full duration
+    """
+    end = 10**(to_gain/20)
+    gain = np.linspace(1, end, len(data), endpoint=False)[:,None]
+    info = np.iinfo(fmt.dtype)
+    return np.clip(data*gain, info.min, info.max).astype(fmt.dtype)
+
+def concatenate_clips(clips):
+    """
+    Concatenate AudioSegments, skipping Nones. Returns the array and its format.
+    """
+    clips = [x for x in clips if x is not None]
+    if len(clips) == 0:
+        fmt = canonical
+        return np.empty((0, fmt.channels), dtype=fmt.dtype), fmt
+    fmt = common_format(clips)
+    return concatenate([to_array(x, fmt) for x in clips], fmt), fmt
+
+def overlay_clips(clips):
+    """
+    Overlay AudioSegments, skipping Nones. Returns an AudioSegment.
+    """
+    clips = [x for x in clips if x is not None]
+    if len(clips) == 0: return None
+    fmt = common_format(clips)
+    return to_segment(overlay([to_array(x, fmt) for x in clips], fmt), fmt)
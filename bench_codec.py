@@ -0,0 +1,52 @@
+import timeit
+
+import ipc
+
+"""
+Compares encode/decode time and bytes on the wire for each ipc codec using
+a TTSClient.send_chat payload that looks like a real twitch message.
+"""
+
+tags = {
+    'badge-info': 'subscriber/14',
+    'badges': 'moderator/1,subscriber/12',
+    'client-nonce': 'a4f1c2a0b3d94c5e8f7a6b5c4d3e2f10',
+    'color': '#1E90FF',
+    'display-name': 'SomeChatter',
+    'emotes': '25:0-4,12-16/1902:6-10',
+    'first-msg': '0',
+    'flags': None,
+    'id': '6c9c4b1e-3a9f-4a4e-9b1c-2e5f8d7c6b5a',
+    'mod': '1',
+    'room-id': '83429318',
+    'subscriber': '1',
+    'tmi-sent-ts': '1666123456789',
+    'turbo': '0',
+    'user-id': '89786611',
+    'user-type': 'mod',
+}
+
+text = 'Kappa Keepo Kappa that was a clean pass https://beatsaver.com/maps/1a2b3 LUL'
+
+payload = {
+    'kind': 'chat',
+    'data': {
+        'msg': text,
+        'tags': tags,
+        'history': {'msg': 'first', 'tags': tags},
+        'play_kwargs': {},
+        },
+    }
+
+def run(number = 20000):
+    print(f'{"codec":>8} {"bytes":>6} {"encode us":>10} {"decode us":>10}')
+    for codec in ipc.codecs:
+        frame = ipc.encode(payload, codec)
+        assert ipc.decode(frame) == payload
+
+        enc = timeit.timeit(lambda: ipc.encode(payload, codec), number=number)
+        dec = timeit.timeit(lambda: ipc.decode(frame), number=number)
+        print(f'{codec.name:>8} {len(frame):>6} {enc/number*1e6:>10.2f} {dec/number*1e6:>10.2f}')
+
+if __name__ == '__main__':
+    run()
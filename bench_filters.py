@@ -0,0 +1,134 @@
+import re
+import timeit
+
+import tts
+import filters
+import message
+import bench_pipeline
+
+"""
+Checks that filters.FilterChain gives the same snippets as the original
+filters and fixed point loop on a chat corpus plus some awkward cases, then
+compares how long they take.
+"""
+
+url = 'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+'
+
+class ReferenceModemReplace():
+    """
+    The original RegexReplace/ModemReplace
+    """
+    def __init__(self, pattern):
+        self.re = pattern
+
+    def process(self, snippet):
+        if not isinstance(snippet, tts.SpeechSnippet): return False
+
+        pieces = re.split(self.re, snippet.text)
+        matches = re.findall(self.re, snippet.text)
+        if len(pieces) == 1: return False
+
+        result = []
+        for idx, piece in enumerate(pieces):
+            result.append(tts.SpeechSnippet(piece, snippet.config))
+            if idx < len(pieces) - 1:
+                result.append(tts.ModemSnippet(matches[idx]))
+        return result
+
+class ReferenceTooLongTruncate():
+    def __init__(self, max_length):
+        self.max_length = max_length
+
+    def process(self, snippet):
+        if not isinstance(snippet, tts.SpeechSnippet): return False
+
+        otext = snippet.text
+        pieces = otext.split(' ')
+        pieces = list(map(lambda x: x[:self.max_length], pieces))
+        text = ' '.join(pieces)
+        if text == otext: return False
+        return [tts.SpeechSnippet(text, snippet.config)]
+
+class ReferenceCustomFilter():
+    """
+    The original message.CustomFilter, which filters.RuleFilter's sounds replaced
+    """
+    filemap = {
+        'BibleThump': 'emote_sounds/kefka.mp3'
+    }
+    def process(self, snippet):
+        if not isinstance(snippet, tts.EmoteSnippet): return False
+
+        filename = self.filemap.get(snippet.emote_name, None)
+        if filename == None: return False
+
+        return [tts.Mp3Snippet(filename)]
+
+reference_filters = [ReferenceModemReplace(url), ReferenceTooLongTruncate(30), ReferenceCustomFilter()]
+
+chain = filters.FilterChain([
+    filters.ModemReplace(url, None),
+    filters.RuleFilter(sounds = ReferenceCustomFilter.filemap),
+    filters.TooLongTruncate(30),
+    ])
+
+def reference_process(result):
+    """
+    The original Message.process
+    """
+    max_depth = 10
+    depth = 0
+    done = False
+    while not done and depth < max_depth:
+        done = True
+        depth += 1
+        for idx, snippet in enumerate(result):
+            for filt in reference_filters:
+                tsnips = filt.process(snippet)
+                if tsnips != False:
+                    result[idx:idx+1] = tsnips
+                    done = False
+                    break
+    return result
+
+def describe(snippets):
+    return [(type(x).__name__, [getattr(x, f) for f in x.fields], x.config) for x in snippets]
+
+edge_cases = [
+    '',
+    'https://a.com',
+    'look https://a.com/x and http://b.org/y?z=1 twice',
+    'https://a.com' + 'x'*80 + ' trailing',
+    'a'*31 + ' ' + 'b'*30 + '  double  spaces ',
+    'BibleThump BibleThump',
+    'nohttp://here but xhttps://there.com',
+]
+
+def make_messages(count, seed):
+    tags = {'user-id': '1', 'display-name': 'edge', 'badges': None, 'emotes': None}
+    corpus = bench_pipeline.make_corpus(count, seed)
+    corpus += [{'msg': x, 'tags': tags, 'history': None} for x in edge_cases]
+    emote_tags = dict(tags, emotes='1:0-9,11-20')
+    corpus.append({'msg': 'BibleThump BibleThump', 'tags': emote_tags, 'history': None})
+    return [message.Message(**x) for x in corpus]
+
+def check(messages):
+    for msg in messages:
+        snippets = msg.preprocess()
+        expected = describe(reference_process(list(snippets)))
+        actual = describe(chain.process(list(snippets)))
+        assert actual == expected, (msg.msg, actual, expected)
+
+def run(count = 500, seed = 7852, number = 5):
+    messages = make_messages(count, seed)
+    check(messages)
+    print(f'{len(messages)} messages match')
+
+    preprocessed = [x.preprocess() for x in messages]
+    old = timeit.timeit(lambda: [reference_process(list(x)) for x in preprocessed], number=number)/number
+    new = timeit.timeit(lambda: [chain.process(list(x)) for x in preprocessed], number=number)/number
+    print(f'{"loop ms":>10} {"chain ms":>10} {"speedup":>8}')
+    print(f'{old*1000:>10.2f} {new*1000:>10.2f} {old/new:>8.1f}')
+
+if __name__ == '__main__':
+    run()
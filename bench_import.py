@@ -0,0 +1,53 @@
+import sys
+import subprocess
+
+"""
+Measures how long each module takes to import in a fresh interpreter and
+checks it against a budget, so services that never speak (chatbot, the
+overlay, the listeners) stay quick to start. Also checks that importing them
+doesn't drag in the tts engines or an audio backend. Exits non-zero if
+anything is over budget.
+"""
+
+budgets = { #module: ms
+    'ipc': 150,
+    'filters': 400,
+    'tts': 400,
+    'message': 400,
+}
+
+#Modules that should only be imported once something renders or plays
+deferred = ['gtts', 'pyttsx3', 'pydub.playback', 'requests']
+
+def measure(name, repeats = 3):
+    """
+    Best of repeats import times in ms, and which deferred modules got
+    imported anyway
+    """
+    code = '\n'.join([
+        'import sys, time',
+        'start = time.perf_counter()',
+        f'import {name}',
+        'print((time.perf_counter()-start)*1000)',
+        f'print(",".join(x for x in {deferred!r} if x in sys.modules))',
+        ])
+    best = None
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.splitlines()
+        ms = float(out[0])
+        best = ms if best is None else min(best, ms)
+    leaked = [x for x in out[1].split(',') if x != ''] if len(out) > 1 else []
+    return best, leaked
+
+def run():
+    ok = True
+    print(f'{"module":>10} {"ms":>8} {"budget":>8}  leaked')
+    for name, budget in budgets.items():
+        ms, leaked = measure(name)
+        over = ms > budget or len(leaked) > 0
+        ok = ok and not over
+        print(f'{name:>10} {ms:>8.1f} {budget:>8}  {", ".join(leaked)}{"  OVER" if over else ""}')
+    return ok
+
+if __name__ == '__main__':
+    sys.exit(0 if run() else 1)
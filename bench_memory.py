@@ -0,0 +1,114 @@
+import json
+import time
+import argparse
+import tracemalloc
+
+import tts
+import message
+import bench_pipeline
+
+"""
+Memory and construction time of message.Message over a chat corpus, plus how
+much the __slots__ snippets and users save over the original dict based ones
+holding the same content.
+
+A recorded corpus is a file with one send_chat payload ({"msg", "tags",
+"history"}) per line. Without one, this uses bench_pipeline's seeded corpus.
+
+> python bench_memory.py [--corpus chat.jsonl] [--count 2000]
+"""
+
+class DictSnippet():
+    """
+    The original tts.Snippet, with its content in a data dict
+    """
+    def __init__(self, data, config = {'voice_name':'zira'}):
+        self.data = data
+        self.config = config
+
+class DictUser():
+    """
+    The original message.User, with badges parsed up front into lists
+    """
+    def __init__(self, msg, tags):
+        self.msg = msg
+        self.tags = tags
+
+        self.id = tags.get('user-id') 
+        self.display_name = tags.get('display-name')
+    
+        self.badges = []
+        tag_badges = tags.get('badges', None)
+        if tag_badges is not None:
+            for b in tag_badges.split(','):
+                self.badges.append(b.split('/'))
+
+        self.configs = {}
+
+def load_corpus(filename):
+    with open(filename, 'r') as f:
+        return [json.loads(x) for x in f if x.strip() != '']
+
+def measure(build):
+    """
+    Bytes still allocated by what build returns, and how long it took
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    seconds = time.perf_counter()-start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size, seconds
+
+def build_messages(corpus):
+    return [message.Message(x['msg'], x['tags'], x['history']) for x in corpus]
+
+def build_parts(messages, snippet, user):
+    """
+    Just the snippets and users of already built messages, copied into
+    either representation
+    """
+    result = []
+    for msg in messages:
+        result.append([snippet(x) for x in msg.snippets])
+        result.append(user(msg.msg, msg.tags))
+        if msg.past_user is not None:
+            result.append(user(msg.past_user.msg, msg.past_user.tags))
+    return result
+
+def slotted_snippet(snippet):
+    return type(snippet)(*[getattr(snippet, x) for x in snippet.fields], snippet.config)
+
+def dict_snippet(snippet):
+    return DictSnippet({x: getattr(snippet, x) for x in snippet.fields}, snippet.config)
+
+def run(corpus):
+    count = len(corpus)
+    build_messages(corpus[:50]) #Warm up the filter chain and lazy imports
+
+    size, seconds = measure(lambda: build_messages(corpus))
+    print(f'{count} messages: {seconds/count*1e6:.1f} us and {size/count:.0f} bytes per message')
+
+    messages = build_messages(corpus)
+    print(f'{"snippets+users":>15} {"bytes/msg":>10} {"us/msg":>8}')
+    for name, snippet, user in [('slots', slotted_snippet, message.User), ('dicts', dict_snippet, DictUser)]:
+        size, seconds = measure(lambda: build_parts(messages, snippet, user))
+        print(f'{name:>15} {size/count:>10.0f} {seconds/count*1e6:>8.1f}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--corpus', help='recorded chat, one send_chat payload per line')
+    parser.add_argument('--count', type=int, default=2000, help='messages in the seeded corpus')
+    parser.add_argument('--seed', type=int, default=7852)
+    args = parser.parse_args()
+
+    if args.corpus is not None:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = bench_pipeline.make_corpus(args.count, args.seed)
+    run(corpus)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import timeit
+
+import tts
+
+"""
+Compares ModemSnippet.synthesize against the original pure python loops on long
+urls, and checks that they produce the same samples.
+"""
+
+urls = [
+    'https://beatsaver.com/maps/1a2b3',
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI&index=1',
+    'https://example.com/' + '/'.join(f'segment{x}?query={x*x}&other=%20value' for x in range(40)),
+]
+
+def reference_render(text, duration = 0.75):
+    """
+    The original ModemSnippet.render, returning raw sample bytes
+    """
+    count = len(text)
+    fs = 44100
+    sps =16
+    base_dur = sps*8*count/fs
+    repeats = max(1,int(duration/base_dur))
+    bits = []
+    for char in text:
+        for _ in range(repeats):
+            bits.extend(list(bin(ord(char)))[2:])
+    data = []
+    for bit in bits:
+        if bit == '0': value = 0x00
+        else: value = 0x40
+        data.extend([value]*sps)
+    return bytes(data)
+
+def run(number = 20):
+    print(f'{"chars":>6} {"loops ms":>10} {"numpy ms":>10} {"speedup":>8}')
+    for url in urls:
+        snippet = tts.ModemSnippet(url)
+        assert snippet.synthesize().raw_data == reference_render(url)
+
+        old = timeit.timeit(lambda: reference_render(url), number=number)/number
+        new = timeit.timeit(lambda: snippet.synthesize(), number=number)/number
+        print(f'{len(url):>6} {old*1000:>10.3f} {new*1000:>10.3f} {old/new:>8.1f}')
+
+if __name__ == '__main__':
+    run()
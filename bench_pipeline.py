@@ -0,0 +1,199 @@
+import time
+import random
+import argparse
+
+import tts
+import message
+import render_cache
+import timing
+import ipc
+import throttle
+import tts_listener
+
+"""
+End-to-end benchmark of everything around the tts engine: building
+messages (filters, snippet assembly), rendering and assembling audio, ipc, and
+the tts_listener pipeline. Uses tts.SyntheticTTS and a player that doesn't
+make any sound, so it runs anywhere and the same arguments give the same
+work every time.
+
+> python bench_pipeline.py [--count 200] [--latency 0.01] [--workers 0]
+"""
+
+#zmq closes sockets in the background, so each stage gets its own port rather
+#than racing to bind the one the last stage just closed
+bench_ports = {'ipc': 17854, 'listener': 17855}
+
+words = [
+    'the', 'map', 'was', 'clean', 'pog', 'nice', 'that', 'hit', 'so', 'hard',
+    'what', 'is', 'this', 'song', 'again', 'lol', 'no', 'way', 'full', 'combo',
+    'supercalifragilisticexpialidociousness', 'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+]
+#None of these map to sound files, which aren't part of the repo
+emotes = {'Kappa': '25', 'Kreygasm': '41', 'ResidentSleeper': '245', 'PogChamp': '88'}
+users = [
+    ('1001', 'regular_viewer', None),
+    ('1002', 'SomeMod', 'moderator/1'),
+    ('1003', 'subbed_up', 'subscriber/12'),
+    ('1004', 'lurker', None),
+    ('83429318', 'broadcaster', 'broadcaster/1'),
+]
+
+def make_corpus(count, seed = 7852):
+    """
+    A reproducible list of send_chat payloads that look like twitch chat
+    """
+    rng = random.Random(seed)
+    result = []
+    history = None
+    for _ in range(count):
+        user_id, name, badges = rng.choice(users)
+        tokens = rng.choices(words, k=rng.randint(1, 12))
+        for _ in range(rng.randint(0, 2)):
+            tokens.insert(rng.randint(0, len(tokens)), rng.choice(list(emotes.keys())))
+        if rng.random() < 0.1:
+            tokens.append(f'https://beatsaver.com/maps/{rng.randint(0, 0xfffff):x}')
+        text = ' '.join(tokens)
+
+        ranges = {}
+        idx = 0
+        for token in tokens:
+            if token in emotes:
+                ranges.setdefault(emotes[token], []).append(f'{idx}-{idx+len(token)-1}')
+            idx += len(token)+1
+        tags = {
+            'user-id': user_id,
+            'display-name': name,
+            'badges': badges,
+            'emotes': '/'.join(f'{k}:{",".join(v)}' for k, v in ranges.items()) or None,
+            }
+        result.append({'msg': text, 'tags': tags, 'history': history, 'play_kwargs': {}})
+        history = {'msg': text, 'tags': tags}
+    return result
+
+def silent_player(clip):
+    pass
+
+def setup(engine_configs):
+    """
+    Use the synthetic engine and a memory-only cache, in this process and in
+    render pool workers
+    """
+    tts.use_engine('synthetic', engine_configs)
+    tts.TTS.cache = render_cache.RenderCache(cache_dir = None)
+
+def timed(tracer, stage, func, items):
+    for item in items:
+        with tracer.span(None, stage):
+            func(item)
+
+def bench_messages(corpus, tracer):
+    messages = []
+    timed(tracer, 'construct', lambda x: messages.append(message.Message(**x)), corpus)
+
+    for msg in messages:
+        msg.stream = False
+    tts.TTS.cache.clear()
+    timed(tracer, 'render_cold', lambda x: x.render(), messages)
+    timed(tracer, 'render_warm', lambda x: x.render(), messages)
+
+def bench_ipc(corpus, tracer):
+    server = ipc.Server(bench_ports['ipc'], hwm = len(corpus)+10)
+    client = BenchClient(bench_ports['ipc'], hwm = len(corpus)+10)
+    time.sleep(0.2) #Let the connection and codec negotiation settle
+    client.send({'kind': 'warmup'})
+    server.recv(timeout = 1)
+
+    for data in corpus:
+        client.send_chat(data['msg'], data['tags'], data['history'], {})
+    received = 0
+    while received < len(corpus):
+        msgs = server.recv(timeout = 5)
+        if len(msgs) == 0: break
+        for msg in msgs:
+            trace = msg['trace']
+            tracer.record(None, 'ipc', trace['received']-trace['sent'])
+        received += len(msgs)
+    client.close()
+    server.close()
+
+def bench_listener(corpus, tracer):
+    """
+    Push the corpus through ipc into tts_listener's handler and pipeline,
+    reading its own latency stats back out
+    """
+    tts_listener.tracer = tracer
+    tts_listener.scheduler = tts_listener.Scheduler()
+    tts_listener.scheduler.max_depth = len(corpus) #The whole corpus arrives at once
+    #A handful of users sending the whole corpus would mostly be rate limited
+    tts_listener.gate = throttle.ChatGate(throttle.TokenBuckets(rate = 1e9, burst = 1e9), throttle.Deduplicator(window = 0))
+    tts.TTS.cache.clear()
+    server = ipc.Server(bench_ports['listener'], hwm = len(corpus)+10)
+    client = BenchClient(bench_ports['listener'], hwm = len(corpus)+10)
+    pipeline = tts_listener.Pipeline()
+    time.sleep(0.2)
+
+    for data in corpus:
+        client.send_chat(data['msg'], data['tags'], data['history'], {})
+
+    deadline = time.monotonic() + 60 + len(corpus)
+    while time.monotonic() < deadline:
+        done = tracer.stages.get('total', None)
+        done = 0 if done is None else len(done.samples)
+        dropped = sum(tts_listener.scheduler.get_stats()['dropped'].values())
+        gate = tts_listener.gate.get_stats()
+        dropped += gate['duplicates'] + gate['rate_limited']
+        if done + dropped >= len(corpus):
+            break
+        queue = []
+        for msg in server.recv(timeout = 0.1):
+            tts_listener.handle(server, msg, queue)
+        for trace, tts_message in queue:
+            pipeline.put(trace, tts_message)
+    client.close()
+    server.close()
+
+class BenchClient(ipc.TTSMessages, ipc.Client):
+    pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=200, help='messages in the corpus')
+    parser.add_argument('--seed', type=int, default=7852)
+    parser.add_argument('--latency', type=float, default=0.01, help='synthetic seconds per render')
+    parser.add_argument('--latency-per-char', type=float, default=0.0005, help='synthetic seconds per character')
+    parser.add_argument('--workers', type=int, default=0, help='render pool size, 0 renders in process')
+    args = parser.parse_args()
+
+    engine_configs = {'latency': args.latency, 'latency_per_char': args.latency_per_char}
+    setup(engine_configs)
+    message.BaseMessage.player = silent_player
+
+    pool = None
+    if args.workers > 0:
+        import render_pool
+        pool = render_pool.RenderPool(args.workers, setup, (engine_configs,))
+        message.Message.render_pool = pool
+        message.AIMessage.render_pool = pool
+
+    corpus = make_corpus(args.count, args.seed)
+
+    tracer = timing.Tracer(window = args.count)
+    bench_messages(corpus, tracer)
+    bench_ipc(corpus, tracer)
+    print(f'{args.count} messages, seed {args.seed}, latency {args.latency} + {args.latency_per_char}/char, workers {args.workers}')
+    print(timing.format_summary(tracer.summary()))
+
+    tracer = timing.Tracer(window = args.count)
+    bench_listener(corpus, tracer)
+    print('\ntts_listener')
+    print(timing.format_summary(tracer.summary()))
+    stats = tts_listener.scheduler.get_stats()
+    print('scheduled: ' + ', '.join(f'{k}: {v}' for k, v in stats['scheduled'].items()))
+    print('dropped: ' + ', '.join(f'{k}: {v}' for k, v in stats['dropped'].items()))
+
+    if pool is not None:
+        pool.close()
+
+if __name__ == '__main__':
+    main()
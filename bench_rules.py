@@ -0,0 +1,85 @@
+import re
+import random
+import timeit
+import argparse
+
+import tts
+import filters
+import bench_pipeline
+
+"""
+Per-message cost of filters.RuleFilter as the number of rules grows,
+against the same rules as one RegexReplace each. RuleFilter should stay
+about flat for literal rules. Regex rules share one alternation, which is
+one scan but still tries each alternative, so they're kept to a handful.
+
+Also checks that replacements are read as written, not matched again.
+
+> python bench_rules.py [--count 300]
+"""
+
+one_pass_cases = [ #rules, text, what should be read
+    ({'replace': {'bs': 'BS plus'}}, 'love bs', 'love BS plus'),
+    ({'replace': {'a': 'b', 'b': 'c'}}, 'a b', 'b c'),
+    ({'regex_replace': {'lo+l': 'lol lol'}}, 'lool', 'lol lol'),
+]
+
+def check():
+    for rules, text, expected in one_pass_cases:
+        chain = filters.FilterChain([filters.RuleFilter(**rules), filters.TooLongTruncate(30)])
+        actual = [x.text for x in chain.process([tts.SpeechSnippet(text)])]
+        assert actual == [expected], (rules, text, actual)
+
+def make_words(count, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return [''.join(rng.choices(letters, k=rng.randint(4, 10))) for _ in range(count)]
+
+def make_rules(count, seed = 7852):
+    rng = random.Random(seed)
+    words = make_words(count, rng)
+    #Make sure some of them actually match the corpus
+    words[:len(bench_pipeline.words)//2] = bench_pipeline.words[:len(bench_pipeline.words)//2]
+    replace = {x: x.upper() for x in words[::2]}
+    block = words[1::2]
+    regex_replace = {r'(?:lo)+l': 'laughing', r'a{5,}': 'a'}
+    regex_block = [r'\d{6,}']
+    return replace, block, regex_replace, regex_block
+
+class BlockReplace(filters.RegexReplace):
+    """
+    A rule as its own filter, the way it would be done without RuleFilter.
+    Like RuleFilter, its replacements aren't matched again.
+    """
+    rescan = False
+    def get_replacement(self, match):
+        return tts.SpeechSnippet(self.replacement)
+
+def separate_filters(replace, block, regex_replace, regex_block):
+    result = []
+    for word, replacement in list(replace.items()) + [(x, '') for x in block]:
+        result.append(BlockReplace(r'(?i)\b' + re.escape(word) + r'\b', replacement))
+    for pattern, replacement in list(regex_replace.items()) + [(x, '') for x in regex_block]:
+        result.append(BlockReplace(pattern, replacement))
+    return filters.FilterChain(result)
+
+def per_message(chain, snippets, number = 3):
+    seconds = timeit.timeit(lambda: [chain.process(list(x)) for x in snippets], number=number)/number
+    return seconds/len(snippets)*1e6
+
+def run(count = 300, sizes = (10, 100, 1000, 10000), separate_limit = 1000):
+    check()
+    print(f'{len(one_pass_cases)} one pass cases match')
+    corpus = bench_pipeline.make_corpus(count)
+    snippets = [[tts.SpeechSnippet(x['msg'])] for x in corpus]
+    print(f'{"rules":>6} {"rule filter us":>15} {"separate us":>12}')
+    for size in sizes:
+        rules = make_rules(size)
+        combined = per_message(filters.FilterChain([filters.RuleFilter(*rules)]), snippets)
+        separate = per_message(separate_filters(*rules), snippets, 1) if size <= separate_limit else None
+        separate = '' if separate is None else f'{separate:.1f}'
+        print(f'{size:>6} {combined:>15.1f} {separate:>12}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=300, help='messages in the corpus')
+    run(parser.parse_args().count)
@@ -17,7 +17,7 @@ class BaseMonitor():
         self.history = []
         self.ws = None
         self.running = True
-        self.overlay = ipc.OverlayClient()
+        self.overlay = ipc.Publisher()
         self.last_error = None
         self.norepeat_errors = set([10061])
     
@@ -22,17 +22,10 @@ import threading
 
 import secrets
 
-from gtts import gTTS
-
 import tts
-import message
 
 import ipc
-
-from pydub import AudioSegment
-from pydub.playback import play
-import pydub.effects as fx
-import pydub.playback as playback
+import config_store
 
 class TwitchBot(irc.bot.SingleServerIRCBot):
     tts_subs = {
@@ -63,32 +56,21 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         print('Connecting to ' + server + ' on port ' + str(port) + '...', flush=True)
         irc.bot.SingleServerIRCBot.__init__(self, [(server, port, 'oauth:'+token)], username, username)
         print('Connected', flush=True)
-        self.user_configs_file = user_configs
-        self.user_configs = json.load(open(self.user_configs_file, 'r'))
-        self.configs_changed = False
+        self.user_configs = config_store.open_store(user_configs)
 
         self.last_speaker = 0
 
         self.tts_client = ipc.TTSClient()
+        #Send anything held while tts was behind, even if chat goes quiet
+        self.reactor.scheduler.execute_every(1, self.tts_client.flush)
 
         self.history = []
 
-    def save_configs(self):
-        print('* Saved configs')
-        json.dump(self.user_configs, open(self.user_configs_file, 'w'))
-        self.configs_changed = False
-
     def get_user_config(self, tags, key, default = None):
-        user_id = tags.get('user-id')
-        user = self.user_configs.get(user_id, {key:default})
-        return user.get(key, None)
+        return self.user_configs.get(tags.get('user-id'), key, default)
 
     def set_user_config(self, tags, key, value):
-         user_id = tags.get('user-id')   
-         user = self.user_configs.get(user_id, {})       
-         self.user_configs[user_id] = user
-         user[key] = value
-         self.configs_changed = True
+        self.user_configs.set(tags.get('user-id'), key, value)
 
     def check_mod(self, tags):
         """
@@ -105,6 +87,7 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         return tags.get('msg-id', None) == 'highlighted-message'
 
     def check_lang(self, lang):
+        from gtts import gTTS
         gTTS('t', lang=lang)
 
     def on_welcome(self, c, e):
@@ -143,7 +126,7 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         snippets = self.split_emotes(msg, tags)
 
         if user != self.last_speaker and self.say_names:
-            snippets.insert(0, tts.SpeechSnippet({'text': speaker}, {'max_length: 1'}))
+            snippets.insert(0, tts.SpeechSnippet(speaker, {'max_length': 1}))
 #            snippets.insert(0, SpeechSnippet('ctext', {'text': speaker, 'max_length':1}))
 
         print(snippets)
@@ -176,7 +159,10 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         hist = None
         if len(self.history) > 0:
             hist = self.history[-1]
-        self.tts_client.send_chat(text, tags, hist, play_kwargs)
+        result = self.tts_client.send_chat(text, tags, hist, play_kwargs)
+        if result == ipc.SendResult.QUEUE_FULL:
+            print(f'* TTS is behind, dropped message from {tags.get("display-name")}')
+            return
         
         self.history.append({'msg': text, 'tags': tags})
 
@@ -262,9 +248,6 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             pass
 #            c.privmsg(self.channel, "Did not understand command: " + cmd)
 
-        if self.configs_changed:
-            self.save_configs()
-
 
 def main():
 
@@ -285,6 +268,8 @@ def main():
         bot.start()
     except (KeyboardInterrupt, Exception):
         pass
+    finally:
+        bot.user_configs.close()
     
 
 if __name__ == "__main__":
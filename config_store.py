@@ -0,0 +1,171 @@
+import os
+import stat
+import json
+import sqlite3
+import tempfile
+import threading
+
+################
+# Config Store #
+################
+
+"""
+Per-user settings like a chatter's tts language. Reads come from memory and
+changes are written out in the background a little later, so commands in
+the irc thread never wait on the disk. open_store picks the backend from the
+file name.
+"""
+
+#What open gives new files, for files that are written elsewhere and moved
+#into place. Read once at import, since reading it means changing it.
+umask = os.umask(0)
+os.umask(umask)
+
+class JSONBackend():
+    """
+    The whole store in one json file, rewritten atomically on every flush
+    """
+    writes_all = True #save needs every user, not just the ones that changed
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        if not os.path.exists(self.filename): return {}
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+
+    def save(self, configs):
+        fd, path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(configs, f)
+            os.chmod(path, self.get_mode()) #mkstemp files are owner only
+            os.replace(path, self.filename)
+        except BaseException:
+            os.remove(path)
+            raise
+
+    def get_mode(self):
+        """
+        The permissions of the file being replaced, or what open would give a
+        new one
+        """
+        try:
+            return stat.S_IMODE(os.stat(self.filename).st_mode)
+        except FileNotFoundError:
+            return 0o666 & ~umask
+
+class SQLiteBackend():
+    """
+    One row per user, so a flush only writes the users that changed
+    """
+    writes_all = False
+
+    def __init__(self, filename):
+        self.filename = filename
+        db = self.connect()
+        try:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS user_configs (user_id TEXT PRIMARY KEY, configs TEXT NOT NULL)')
+        finally:
+            db.close()
+
+    def connect(self):
+        return sqlite3.connect(self.filename)
+
+    def load(self):
+        db = self.connect()
+        try:
+            return {user_id: json.loads(configs) for user_id, configs in db.execute('SELECT user_id, configs FROM user_configs')}
+        finally:
+            db.close()
+
+    def save(self, configs):
+        db = self.connect()
+        try:
+            with db:
+                db.executemany(
+                    'INSERT OR REPLACE INTO user_configs (user_id, configs) VALUES (?, ?)',
+                    [(k, json.dumps(v)) for k, v in configs.items()],
+                    )
+        finally:
+            db.close()
+
+class ConfigStore():
+    """
+    User configs in memory, flushed to backend delay seconds after the first
+    change since the last flush, so a burst of changes is written once. A
+    failed flush is tried again retry_delay seconds later. Call close to
+    write anything still pending.
+    """
+    retry_delay = 10
+
+    def __init__(self, backend, delay = 2):
+        self.backend = backend
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock() #Keeps flushes in order
+        self.configs = backend.load() #user id: {key: value}
+        self.changed = set()
+        self.timer = None
+
+    def key(self, user_id):
+        """
+        User ids the way json writes dict keys, so they match after a reload
+        """
+        return 'null' if user_id is None else str(user_id)
+
+    def get(self, user_id, key, default = None):
+        with self.lock:
+            return self.configs.get(self.key(user_id), {}).get(key, default)
+
+    def set(self, user_id, key, value):
+        user_id = self.key(user_id)
+        with self.lock:
+            self.configs.setdefault(user_id, {})[key] = value
+            self.changed.add(user_id)
+            self.schedule(self.delay)
+
+    def schedule(self, delay):
+        """
+        Flush in delay seconds unless a flush is already coming. Call with
+        lock held.
+        """
+        if self.timer is None:
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                self.timer = None
+                if len(self.changed) == 0: return
+                changed = self.changed
+                self.changed = set()
+                users = self.configs.keys() if self.backend.writes_all else changed
+                configs = {x: dict(self.configs[x]) for x in users}
+            try:
+                self.backend.save(configs)
+                print(f'* Saved configs for {len(changed)} users')
+            except Exception as e:
+                print(f'Failed to save configs, trying again in {self.retry_delay} seconds: {e}')
+                with self.lock:
+                    self.changed |= changed
+                    self.schedule(self.retry_delay)
+
+    def close(self):
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+def open_store(filename, delay = 2):
+    """
+    A ConfigStore backed by sqlite for .db/.sqlite files, or json otherwise
+    """
+    if os.path.splitext(filename)[1] in {'.db', '.sqlite', '.sqlite3'}:
+        return ConfigStore(SQLiteBackend(filename), delay)
+    return ConfigStore(JSONBackend(filename), delay)
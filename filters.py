@@ -1,13 +1,9 @@
+import os
 import re
+import json
 
-import requests
 import tts
 
-from pydub import AudioSegment
-from pydub.playback import play
-import pydub.effects as fx
-import pydub.playback as playback
-
 ###################
 # Message Filters #
 ###################
@@ -16,11 +12,18 @@ import pydub.playback as playback
 A filter just takes a snippet via its process function and returns either
 * False if it didn't change anything
 * A list of snippets to replace the one it was given if it did
+
+applies_to is the snippet class a filter can change, so FilterChain doesn't
+have to ask it about anything else. A filter with rescan = False only sends
+what it returns on to the filters after it, never back through itself.
 """
 
 class RegexReplace():
-    def __init__(self, re, replacement):
-        self.re = re
+    applies_to = tts.SpeechSnippet
+
+    def __init__(self, pattern, replacement):
+        self.re = pattern
+        self.compiled = re.compile(pattern)
         self.replacement = replacement
 
     def get_replacement(self, match):
@@ -29,16 +32,15 @@ class RegexReplace():
     def process(self, snippet):
         if not isinstance(snippet, tts.SpeechSnippet): return False
 
-        pieces = re.split(self.re, snippet.data['text'])
-        matches = re.findall(self.re, snippet.data['text'])
-        if len(pieces) == 1: return False
-
+        text = snippet.text
         result = []
-        for idx, piece in enumerate(pieces):
-            result.append(tts.SpeechSnippet({'text': piece}, snippet.config))
-            if idx < len(pieces) - 1:
-                result.append(self.get_replacement(matches[idx]))
-#                result.append(self.replacement)
+        last = 0
+        for match in self.compiled.finditer(text):
+            result.append(tts.SpeechSnippet(text[last:match.start()], snippet.config))
+            result.append(self.get_replacement(match.group()))
+            last = match.end()
+        if len(result) == 0: return False
+        result.append(tts.SpeechSnippet(text[last:], snippet.config))
 
         return result
 
@@ -47,24 +49,244 @@ class ModemReplace(RegexReplace):
     Like regex replace, but generate a ModemSnippet from the match
     """
     def get_replacement(self, match):
-        print(match)
-        return tts.ModemSnippet({'text': match})
+        return tts.ModemSnippet(match)
 
 class TooLongTruncate():
+    applies_to = tts.SpeechSnippet
+
     def __init__(self, max_length):
         self.max_length = max_length
+        self.too_long = re.compile(f'[^ ]{{{max_length+1},}}')
 
     def process(self, snippet):
         if not isinstance(snippet, tts.SpeechSnippet): return False
 
-        otext = snippet.data['text']
+        otext = snippet.text
+        if self.too_long.search(otext) is None: return False
         pieces = otext.split(' ')
-        pieces = list(map(lambda x: x[:self.max_length], pieces))
+        pieces = [x[:self.max_length] for x in pieces]
         text = ' '.join(pieces)
-        if text == otext: return False
-        result = [tts.SpeechSnippet({'text': text}, snippet.config)]
+        result = [tts.SpeechSnippet(text, snippet.config)]
+
+        return result
+
+class Automaton():
+    """
+    Aho-Corasick automaton over a dict of literal strings. finditer finds
+    every occurrence of all of them in a single pass over the text, so it
+    costs the same however many strings there are.
+    """
+    def __init__(self, words):
+        self.goto = [{}]  #node: {char: node}
+        self.fail = [0]   #node: longest proper suffix that's also a node
+        self.out = [()]   #node: ((length, value), ...) of words ending here
+        for word, value in words.items():
+            if len(word) > 0:
+                self.add(word, value)
+        self.build()
+
+    def add(self, word, value):
+        node = 0
+        for char in word:
+            child = self.goto[node].get(char, None)
+            if child is None:
+                child = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+                self.goto[node][char] = child
+            node = child
+        self.out[node] = ((len(word), value),)
+
+    def build(self):
+        """
+        Fill in the fail links breadth first, so each node also reports the
+        words that end at its suffixes
+        """
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+                queue.append(child)
+
+    def finditer(self, text):
+        """
+        Yield (start, end, value) for every occurrence, overlapping or not
+        """
+        if len(self.goto[0]) == 0: return
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for idx, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in out[node]:
+                yield idx+1-length, idx+1, value
+
+def scope_flags(pattern):
+    """
+    Turn leading global flags like (?i)foo into a scoped group (?i:foo), since
+    global flags aren't allowed in the middle of a combined pattern
+    """
+    match = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+    if match is None: return pattern
+    flags, rest = match.group(1), pattern[match.end():]
+    end = '\n)' if 'x' in flags else ')' #A trailing comment would swallow the )
+    return f'(?{flags}:{rest}{end}'
+
+class RuleFilter():
+    """
+    Word replacements, blocklists and emote sounds, usually loaded from a
+    config file with load. Literal rules are matched as whole words, ignoring
+    case, by one Automaton, and regex rules are combined into one
+    alternation, so each snippet is scanned once however many rules there
+    are. Where matches overlap, the one that starts first wins, then the
+    longest.
+
+    Replacements are plain text, and aren't scanned again for more matches.
+    Regexes can't use numbered backreferences, since they're renumbered when
+    combined. Regexes that don't compile are reported and skipped.
+    """
+    applies_to = (tts.SpeechSnippet, tts.EmoteSnippet)
+    rescan = False #A replacement containing its own word would grow forever
+
+    def __init__(self, replace = {}, block = [], regex_replace = {}, regex_block = [], sounds = {}, blocked_text = ''):
+        """
+        replace and regex_replace map what to find to what to say instead,
+        block and regex_block are said as blocked_text, and sounds maps emote
+        names to the mp3 to play instead
+        """
+        literals = {x.lower(): blocked_text for x in block}
+        literals.update({x.lower(): y for x, y in replace.items()})
+        self.literals = Automaton(literals)
+
+        rules = [(x, blocked_text) for x in regex_block] + list(regex_replace.items())
+        parts = []
+        self.groups = {} #group index: replacement
+        names = set()    #named groups so far, which can't repeat in the combined pattern
+        group = 1
+        for pattern, replacement in rules:
+            scoped = scope_flags(pattern)
+            try:
+                compiled = re.compile(scoped)
+                if not names.isdisjoint(compiled.groupindex):
+                    raise re.error(f'group name {", ".join(names & set(compiled.groupindex))} is used by another rule')
+            except re.error as e:
+                print(f'Skipping bad regex rule {pattern!r}: {e}')
+                continue
+            names.update(compiled.groupindex)
+            parts.append(f'({scoped})')
+            self.groups[group] = replacement
+            group += 1 + compiled.groups
+        self.regex = re.compile('|'.join(parts)) if len(parts) > 0 else None
+
+        self.sounds = dict(sounds)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read the rules from a json file with the same keys as the arguments
+        of __init__. A missing file has no rules.
+        """
+        if not os.path.exists(filename): return cls()
+        with open(filename, 'r') as f:
+            return cls(**json.load(f))
 
+    def find(self, text):
+        """
+        Non-overlapping (start, end, replacement) of every rule that matches
+        text, in order
+        """
+        folded = text.lower()
+        if len(folded) != len(text): #Some characters lowercase to more than one
+            folded = text
+        found = []
+        for start, end, replacement in self.literals.finditer(folded):
+            if start > 0 and is_word_char(text[start-1]): continue
+            if end < len(text) and is_word_char(text[end]): continue
+            found.append((start, end, replacement))
+        if self.regex is not None:
+            for match in self.regex.finditer(text):
+                if match.end() > match.start():
+                    found.append((match.start(), match.end(), self.groups[match.lastindex]))
+        found.sort(key = lambda x: (x[0], x[0]-x[1]))
+
+        result = []
+        last = 0
+        for start, end, replacement in found:
+            if start >= last:
+                result.append((start, end, replacement))
+                last = end
         return result
 
+    def process(self, snippet):
+        if isinstance(snippet, tts.EmoteSnippet):
+            filename = self.sounds.get(snippet.emote_name, None)
+            if filename == None: return False
+            return [tts.Mp3Snippet(filename)]
+        if not isinstance(snippet, tts.SpeechSnippet): return False
+
+        text = snippet.text
+        matches = self.find(text)
+        if len(matches) == 0: return False
 
+        pieces = []
+        last = 0
+        for start, end, replacement in matches:
+            pieces.append(text[last:start])
+            pieces.append(replacement)
+            last = end
+        pieces.append(text[last:])
+        return [tts.SpeechSnippet(''.join(pieces), snippet.config)]
+
+def is_word_char(char):
+    return char.isalnum() or char == '_'
+
+class FilterChain():
+    """
+    A list of filters applied to a list of snippets in a single pass. Each
+    snippet goes through the first filter that changes it, and whatever that
+    filter returns goes back through the chain, up to max_depth times, before
+    moving on to the next snippet. What a filter with rescan = False returns
+    only goes through the filters after it. The result is a new list.
+
+    The filters that apply to each kind of snippet are worked out once, the
+    first time that kind shows up.
+    """
+    def __init__(self, filters, max_depth = 10):
+        self.filters = tuple(filters)
+        self.max_depth = max_depth
+        self.by_type = {} #snippet class: (position, filter) of the filters that apply to it
+
+    def get_filters(self, kind):
+        filters = self.by_type.get(kind, None)
+        if filters is None:
+            filters = [(idx, x) for idx, x in enumerate(self.filters) if issubclass(kind, getattr(x, 'applies_to', object))]
+            self.by_type[kind] = filters
+        return filters
+
+    def process(self, snippets):
+        result = []
+        for snippet in snippets:
+            self.rewrite(snippet, result, 0)
+        return result
 
+    def rewrite(self, snippet, result, depth, start = 0):
+        """
+        Append snippet to result once no filter from start on changes it any
+        more
+        """
+        if depth < self.max_depth:
+            for idx, filt in self.get_filters(type(snippet)):
+                if idx < start: continue
+                tsnips = filt.process(snippet)
+                if tsnips != False:
+                    after = start if getattr(filt, 'rescan', True) else idx+1
+                    for tsnip in tsnips:
+                        self.rewrite(tsnip, result, depth+1, after)
+                    return
+        result.append(snippet)
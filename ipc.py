@@ -1,67 +1,752 @@
 import typing
+import atexit
+import enum
+import time
+import uuid
+import threading
 import zmq
+import zmq.asyncio
+import zmq.utils.monitor as zmq_monitor
 import json
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 ports = {
 'overlay': 7852,
 'tts': 7854,
+'bus_in': 7856,  #Publishers connect here
+'bus_out': 7858, #Subscribers connect here
 }
 
+##########
+# Codecs #
+##########
+
+"""
+Every frame starts with a version byte saying how the rest of it is encoded.
+Legacy clients just send_json, so a frame starting with '{' is plain json.
+"""
+
+HELLO = 0x00 #Codec negotiation, payload is a comma separated list of codec names
+
+class JSONCodec():
+    name = 'json'
+    version = 0x01
+
+    def encode(self, data):
+        return json.dumps(data).encode()
+
+    def decode(self, payload):
+        return json.loads(bytes(payload).decode())
+
+class MsgpackCodec():
+    name = 'msgpack'
+    version = 0x02
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+#Codecs in order of preference
+codecs = [JSONCodec()]
+if msgpack is not None:
+    codecs.insert(0, MsgpackCodec())
+
+codecs_by_version = {x.version: x for x in codecs}
+codecs_by_name = {x.name: x for x in codecs}
+
+def encode(data, codec) -> bytes:
+    return bytes([codec.version]) + codec.encode(data)
+
+def decode(frame: bytes):
+    """
+    Decode a frame from any codec this process knows about
+    """
+    if frame[:1] == b'{':
+        return json.loads(frame.decode())
+    codec = codecs_by_version.get(frame[0], None)
+    if codec is None:
+        raise ValueError(f'Unknown codec version {frame[0]}')
+    return codec.decode(frame[1:])
+
+def encode_frames(data, codec) -> typing.List:
+    """
+    Encode a message into the frames to send. Audio in data['pcm'] goes in
+    its own frame as-is instead of through the codec.
+    """
+    pcm = data.get('pcm', None)
+    if pcm is None:
+        return [encode(data, codec)]
+    header = {key: val for key, val in data.items() if key != 'pcm'}
+    return [encode(header, codec), pcm]
+
+def decode_frames(frames) -> typing.Dict:
+    """
+    Inverse of encode_frames for frames received with copy=False. The pcm
+    frame is handed back as a memoryview so it's never copied.
+    """
+    data = decode(frames[0].bytes)
+    if len(frames) > 1:
+        data['pcm'] = frames[1].buffer
+    return data
+
+def hello_frame(names) -> bytes:
+    return bytes([HELLO]) + ','.join(names).encode()
+
+def is_hello(frame: bytes) -> bool:
+    return frame[:1] == bytes([HELLO])
+
+def parse_hello(frame: bytes):
+    return frame[1:].decode().split(',')
+
+def choose_codec(names):
+    """
+    Return our most preferred codec that the peer also supports
+    """
+    for codec in codecs:
+        if codec.name in names:
+            return codec
+    return codecs_by_name['json']
+
+#########
+# Audio #
+#########
+
+"""
+Rendered audio travels as a small header frame plus the raw samples in a
+second frame that zmq sends and receives without copying. pydub and numpy are
+only imported when they're needed so the overlay doesn't need them.
+"""
+
+sample_dtypes = {1: 'i1', 2: '<i2', 4: '<i4'} #Signed like audio.dtypes
+
+def audio_message(audio, kind = 'audio', frame_rate = None) -> typing.Dict:
+    """
+    Wrap an AudioSegment or a NumPy array of samples (frames x channels)
+    in a message. Arrays need a frame_rate and must be int8, int16 or int32.
+    """
+    if hasattr(audio, 'raw_data'):
+        header = {
+            'frame_rate': audio.frame_rate,
+            'sample_width': audio.sample_width,
+            'channels': audio.channels,
+            }
+        pcm = audio.raw_data
+        count = int(audio.frame_count())
+    else:
+        if frame_rate is None:
+            raise ValueError('frame_rate is required for arrays')
+        if audio.dtype not in sample_dtypes.values():
+            raise ValueError(f'Unsupported sample type {audio.dtype}, use int8, int16 or int32')
+        header = {
+            'frame_rate': frame_rate,
+            'sample_width': audio.dtype.itemsize,
+            'channels': 1 if audio.ndim == 1 else audio.shape[1],
+            }
+        pcm = memoryview(audio if audio.flags['C_CONTIGUOUS'] else audio.copy())
+        count = audio.shape[0]
+    header['duration'] = count/header['frame_rate']
+    return {'kind': kind, 'data': header, 'pcm': pcm}
+
+def to_array(msg: typing.Dict):
+    """
+    A read-only NumPy view of the samples in an audio message, shaped
+    (frames, channels). No copies are made.
+    """
+    import numpy as np
+    header = msg['data']
+    samples = np.frombuffer(msg['pcm'], dtype = sample_dtypes[header['sample_width']])
+    return samples.reshape(-1, header['channels'])
+
+def to_segment(msg: typing.Dict):
+    """
+    An AudioSegment of an audio message. AudioSegment only takes bytes, so
+    this costs the one copy.
+    """
+    from pydub import AudioSegment
+    header = msg['data']
+    return AudioSegment(
+        data = bytes(msg['pcm']),
+        sample_width = header['sample_width'],
+        frame_rate = header['frame_rate'],
+        channels = header['channels'],
+        )
+
+###########
+# Sockets #
+###########
+
+"""
+Every socket in a process comes from one shared context, and clients share
+one connection per port. Everything is torn down when the process exits.
+"""
+
+io_threads = 1 #Set before creating any sockets to change
+linger = 500 #ms to keep trying to deliver queued messages on close
+default_hwm = 100 #Approximate number of messages zmq will buffer per socket
+
+context = None
+connections = {} #port: Connection
+
+def get_context() -> zmq.Context:
+    global context
+    if context is None or context.closed:
+        context = zmq.Context(io_threads = io_threads)
+    return context
+
+def shutdown():
+    """
+    Close every socket and the shared context
+    """
+    global context
+    connections.clear()
+    if context is not None and not context.closed:
+        context.destroy(linger = linger)
+    context = None
+
+atexit.register(shutdown)
+
 class Server():
-    def __init__(self, port):
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.ROUTER)
+    def __init__(self, port, hwm = None, topics = None):
+        """
+        hwm limits how many unread messages pile up before senders are told
+        the queue is full. If topics is given, the server also receives those
+        kinds of messages from the bus.
+        """
+        self.socket = get_context().socket(zmq.ROUTER)
+        self.socket.setsockopt(zmq.RCVHWM, default_hwm if hwm is None else hwm)
         self.socket.bind(f'tcp://127.0.0.1:{port}')
+        self.peer_codecs = {} #peer identity: codec for replies
+
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.subscriber = None
+        if topics is not None:
+            self.subscriber = Subscriber(topics, hwm)
+            self.poller.register(self.subscriber.socket, zmq.POLLIN)
         
-    def recv(self) -> typing.Dict:
+    def poll(self, timeout = None) -> bool:
+        """
+        Wait up to timeout seconds for a message to arrive. A timeout of None
+        waits forever. Return True if there is a message ready to recv.
+        """
+        if timeout is not None:
+            timeout = int(timeout*1000)
+        return len(self.poller.poll(timeout)) > 0
+
+    def recv(self, timeout = 0) -> typing.List[typing.Dict]:
+        """
+        Return every message that is ready. By default this doesn't block, but
+        if timeout is given it waits up to that many seconds (forever for None)
+        for the first message to arrive before draining the socket.
+        """
+        if timeout != 0 and not self.poll(timeout):
+            return []
         result = []
+        if self.subscriber is not None:
+            result.extend(self.subscriber.recv())
         while True:
             try:
-                msg = self.socket.recv_multipart(flags= zmq.NOBLOCK)
-                port, data = msg
-                result.append(json.loads(data.decode()))
+                frames = self.socket.recv_multipart(flags= zmq.NOBLOCK, copy= False)
             except zmq.ZMQError as e:
                 return result
+            port = frames[0].bytes
+            if is_hello(frames[1].bytes):
+                codec = choose_codec(parse_hello(frames[1].bytes))
+                self.peer_codecs[port] = codec
+                self.socket.send_multipart([port, hello_frame([codec.name])])
+                continue
+            try:
+                data = decode_frames(frames[1:])
+            except Exception as e:
+                print(f'Failed to decode message: {e}')
+                continue
+            trace = data.setdefault('trace', {})
+            trace['peer'] = port
+            trace['received'] = time.monotonic()
+            result.append(data)
+
+    def reply(self, msg: typing.Dict, data):
+        """
+        Send data back to the client that sent msg in answer to Client.request
+        """
+        trace = msg['trace']
+        if trace.get('peer', None) is None:
+            return #Came from the bus, there's nobody to answer
+        codec = self.peer_codecs.get(trace['peer'], codecs_by_name['json'])
+        frame = encode({'kind': 'reply', 'id': trace.get('id', None), 'data': data}, codec)
+        self.socket.send_multipart([trace['peer'], frame], flags= zmq.NOBLOCK)
+
+    async def arecv(self, timeout = None) -> typing.List[typing.Dict]:
+        """
+        Like recv, but waits on the asyncio event loop instead of blocking the
+        thread. On windows this needs a selector event loop.
+        """
+        if timeout is not None:
+            timeout = int(timeout*1000)
+        poller = zmq.asyncio.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        if self.subscriber is not None:
+            poller.register(self.subscriber.socket, zmq.POLLIN)
+        events = await poller.poll(timeout)
+        if len(events) == 0:
+            return []
+        return self.recv()
+
+    def __iter__(self):
+        """
+        Block until messages arrive and yield them one at a time, forever.
+        """
+        while True:
+            for msg in self.recv(timeout = None):
+                yield msg
+
+    async def __aiter__(self):
+        """
+        async for version of __iter__
+        """
+        while True:
+            for msg in await self.arecv():
+                yield msg
 
     def close(self):
         self.socket.close()
+        if self.subscriber is not None:
+            self.subscriber.close()
             
-class Client():
-    def __init__(self, port):
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.DEALER)
+class Connection():
+    """
+    A DEALER socket to one port, shared by every Client in this process that
+    talks to that port. Like any zmq socket it shouldn't be used from more
+    than one thread at a time.
+    """
+    def __init__(self, port, hwm = None):
+        self.port = port
+        self.users = 0
+        self.socket = get_context().socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, linger)
+        self.socket.setsockopt(zmq.SNDHWM, default_hwm if hwm is None else hwm)
         self.socket.connect(f'tcp://127.0.0.1:{port}')
-        
+
+        #Send json until the server tells us what it can decode
+        self.codec = codecs_by_name['json']
+        self.replies = {} #id: reply data
+        try:
+            self.socket.send(hello_frame([x.name for x in codecs]), flags= zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+
+    def check_incoming(self):
+        """
+        Pick up the server's codec choice and any replies that have arrived
+        """
+        while True:
+            try:
+                frame = self.socket.recv(flags= zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                return
+            if is_hello(frame):
+                names = parse_hello(frame)
+                self.codec = codecs_by_name.get(names[0], self.codec)
+                continue
+            try:
+                reply = decode(frame)
+                self.replies[reply['id']] = reply['data']
+            except Exception as e:
+                print(f'Failed to decode reply: {e}')
+
     def send(self, data: typing.Dict):
+        """
+        Raises zmq.Again instead of blocking when the queue is full
+        """
+        self.check_incoming()
+        self.socket.send_multipart(encode_frames(data, self.codec), flags= zmq.NOBLOCK, copy= False)
+
+    def close(self):
+        self.socket.close()
+
+def get_connection(port, hwm = None) -> Connection:
+    """
+    Return the pooled connection for port, opening it if needed. hwm only
+    applies when the connection is first opened.
+    """
+    conn = connections.get(port, None)
+    if conn is None or conn.socket.closed:
+        conn = connections[port] = Connection(port, hwm)
+    conn.users += 1
+    return conn
+
+def release_connection(conn: Connection):
+    """
+    Close a pooled connection once nothing is using it anymore
+    """
+    conn.users -= 1
+    if conn.users <= 0:
+        conn.close()
+        if connections.get(conn.port, None) is conn:
+            del connections[conn.port]
+
+class SendResult(enum.Enum):
+    SENT = 'sent'             #Handed to zmq
+    QUEUED = 'queued'         #Receiver is behind, held to be sent later
+    QUEUE_FULL = 'queue full' #Receiver is behind, message was dropped
+    NO_RECEIVER = 'no receiver' #Nothing is listening (no bus broker), message was dropped
+    ERROR = 'error'
+
+    def __bool__(self):
+        return self in (SendResult.SENT, SendResult.QUEUED)
+
+class DropPolicy(enum.Enum):
+    """
+    What to do with a message when the receiver is behind
+    """
+    DROP_NEWEST = 'drop newest' #Drop the new message
+    DROP_OLDEST = 'drop oldest' #Hold the new message, dropping the oldest held one of the same kind if there's no room
+    COALESCE = 'coalesce'       #Hold only the latest message of each kind
+
+class Client():
+    """
+    When the receiver falls behind, sends stop blocking and messages are
+    handled according to the drop policy for their kind. Held messages go out
+    on the next send or flush.
+    """
+    policies = {} #kind: DropPolicy
+    default_policy = DropPolicy.DROP_NEWEST
+    backlog = 16 #Max messages held while the receiver is behind
+
+    def __init__(self, port, hwm = None, policies = None):
+        self.port = port
+        self.connection = get_connection(port, hwm)
+        self.socket = self.connection.socket
+        if policies is not None:
+            self.policies = {**self.policies, **policies}
+        self.pending = []
+        self.dropped = 0
+
+    def flush(self) -> bool:
+        """
+        Try to send held messages, return True if none are left
+        """
+        while len(self.pending) > 0:
+            try:
+                self.connection.send(self.pending[0])
+            except zmq.Again:
+                return False
+            self.pending.pop(0)
+        return True
+
+    def hold(self, data: typing.Dict) -> SendResult:
+        kind = data.get('kind', None)
+        policy = self.policies.get(kind, self.default_policy)
+        same_kind = [x for x in self.pending if x.get('kind', None) == kind]
+        if policy == DropPolicy.COALESCE:
+            for old in same_kind:
+                self.pending.remove(old)
+                self.dropped += 1
+        elif policy == DropPolicy.DROP_OLDEST:
+            if len(self.pending) >= self.backlog and len(same_kind) > 0:
+                self.pending.remove(same_kind[0])
+                self.dropped += 1
+
+        if policy == DropPolicy.DROP_NEWEST or len(self.pending) >= self.backlog:
+            self.dropped += 1
+            return SendResult.QUEUE_FULL
+        self.pending.append(data)
+        return SendResult.QUEUED
+
+    def send(self, data: typing.Dict) -> SendResult:
+        """
+        Stamps the message with a trace id and monotonic send time so the
+        receiver can work out how long it took to get there.
+        """
+        data.setdefault('trace', {'id': uuid.uuid4().hex, 'sent': time.monotonic()})
         try:
-            self.socket.send_json(data)
-            return True
+            if not self.flush():
+                return self.hold(data)
+            try:
+                self.connection.send(data)
+            except zmq.Again:
+                return self.hold(data)
+            return SendResult.SENT
         except zmq.ZMQError as e:
             print(e)
-            return False
+            return SendResult.ERROR
         
+    def request(self, data: typing.Dict, timeout = 2):
+        """
+        Send a message and wait up to timeout seconds for the server to reply.
+        Returns None if nothing comes back in time.
+        """
+        if not self.send(data):
+            return None
+        trace_id = data['trace']['id']
+        replies = self.connection.replies
+        deadline = time.monotonic() + timeout
+        while trace_id not in replies:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.socket.poll(int(remaining*1000), zmq.POLLIN) == 0:
+                return None
+            self.connection.check_incoming()
+        return replies.pop(trace_id)
+
     def close(self):
-        self.socket.close()
+        if self.connection is not None:
+            release_connection(self.connection)
+            self.connection = None
         
-class OverlayClient(Client):
-    def __init__(self):
-        super().__init__(ports['overlay'])
-
+class OverlayMessages():
+    """
+    Helpers for sending overlay commands through anything with a send method
+    """
     def send_map(self, lines: typing.List):
-        self.send({'kind': 'new_map', 'data': lines})
+        return self.send({'kind': 'new_map', 'data': lines})
 
     def send_log(self, message: str, level: str = 'info'):
-        self.send({'kind': 'log', 'level': level, 'data': message})
+        return self.send({'kind': 'log', 'level': level, 'data': message})
 
-class TTSClient(Client):
-    def __init__(self):
-        super().__init__(ports['tts'])
-        
+class TTSMessages():
+    """
+    Helpers for sending tts commands through anything with a send method
+    """
     def send_chat(self, text, tags, hist, play_kwargs):
-        self.send({
+        return self.send({
             'kind': 'chat',
             'data': {'msg': text, 'tags': tags, 'history': hist, 'play_kwargs':play_kwargs}
             })
             
     def send_stt(self, text):
-        self.send({'kind': 'stt', 'data': text})
\ No newline at end of file
+        return self.send({'kind': 'stt', 'data': text})
+
+    def send_audio(self, audio, frame_rate = None):
+        """
+        Send pre-rendered audio to be played as-is
+        """
+        return self.send(audio_message(audio, frame_rate = frame_rate))
+
+class OverlayClient(OverlayMessages, Client):
+    policies = {
+        'new_map': DropPolicy.COALESCE,
+        'log': DropPolicy.DROP_OLDEST,
+        }
+
+    def __init__(self, **kwargs):
+        super().__init__(ports['overlay'], **kwargs)
+
+class TTSClient(TTSMessages, Client):
+    policies = {
+        'chat': DropPolicy.DROP_NEWEST, #So chatbot knows what was dropped and keeps its history right
+        'stt': DropPolicy.DROP_OLDEST,
+        'audio': DropPolicy.DROP_OLDEST,
+        }
+
+    def __init__(self, hwm = 10, **kwargs):
+        super().__init__(ports['tts'], hwm = hwm, **kwargs)
+
+    def get_stats(self, timeout = 2):
+        """
+        Ask the tts listener for its latency, render cache, audio conversion,
+        queue and chat gate stats
+        """
+        return self.request({'kind': 'stats'}, timeout)
+
+#######
+# Bus #
+#######
+
+"""
+Publish/subscribe for messages that any number of consumers might want.
+Publishers send each message once to the broker, which forwards it to every
+subscriber that asked for its kind. Subscribers can come and go at runtime.
+The broker is its own process, python ipc.py, and has to be running for
+anything to get through. Delivery is best effort: a subscriber only gets
+what's published after its subscription reaches the broker, so messages
+that must arrive, like speech for tts, go straight to their server instead.
+"""
+
+bus_codec = codecs_by_name['json'] #There's no negotiation on the bus, so use the codec every process has
+
+def topic(kind) -> bytes:
+    """
+    zmq subscriptions match by prefix, so terminate the topic to keep 'log'
+    from matching 'logger'
+    """
+    return f'{kind}\0'.encode()
+
+class Broker():
+    """
+    Forwards everything from publishers on bus_in to subscribers on bus_out.
+    stop tells the proxy to terminate over a control socket, and the proxy's
+    sockets are closed on the thread that ran it.
+    """
+    def __init__(self):
+        ctx = get_context()
+        self.frontend = ctx.socket(zmq.XSUB)
+        self.backend = ctx.socket(zmq.XPUB)
+        self.control = ctx.socket(zmq.PAIR)
+        self.control_address = f'inproc://bus-control-{id(self)}'
+        try:
+            self.frontend.bind(f'tcp://127.0.0.1:{ports["bus_in"]}')
+            self.backend.bind(f'tcp://127.0.0.1:{ports["bus_out"]}')
+            self.control.bind(self.control_address)
+        except zmq.ZMQError as e:
+            self.frontend.close()
+            self.backend.close()
+            self.control.close()
+            raise e
+        self.thread = None
+
+    def run(self):
+        control = get_context().socket(zmq.PAIR)
+        control.connect(self.control_address)
+        try:
+            zmq.proxy_steerable(self.frontend, self.backend, None, control)
+        except zmq.ContextTerminated:
+            pass
+        except zmq.ZMQError as e:
+            print(f'Bus broker stopped: {e}')
+        finally:
+            control.close()
+            self.frontend.close()
+            self.backend.close()
+
+    def start(self):
+        """
+        Run the broker in a background thread
+        """
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the broker started with start and wait for it to finish
+        """
+        self.control.send(b'TERMINATE')
+        self.thread.join()
+        self.control.close()
+
+class Publisher(OverlayMessages, TTSMessages):
+    """
+    Sends messages to the bus. Never blocks; if subscribers are too far
+    behind, zmq drops the message for them. send returns NO_RECEIVER while
+    there's no broker to send to.
+    """
+    def __init__(self, hwm = None, connect_timeout = 0.2):
+        self.socket = get_context().socket(zmq.PUB)
+        self.socket.setsockopt(zmq.LINGER, linger)
+        self.socket.setsockopt(zmq.SNDHWM, default_hwm if hwm is None else hwm)
+        self.monitor = self.socket.get_monitor_socket(zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED)
+        self.connected = False
+        self.socket.connect(f'tcp://127.0.0.1:{ports["bus_in"]}')
+        self.update_connected(connect_timeout) #Give a running broker a moment to accept us
+        if not self.connected:
+            print('No bus broker running, start one with python ipc.py')
+
+    def update_connected(self, timeout = 0):
+        """
+        Catch up on connection events, waiting up to timeout seconds for the
+        first one
+        """
+        if timeout != 0 and self.monitor.poll(int(timeout*1000), zmq.POLLIN) == 0:
+            return
+        while True:
+            try:
+                event = zmq_monitor.recv_monitor_message(self.monitor, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.connected = event['event'] == zmq.EVENT_CONNECTED
+
+    def send(self, data: typing.Dict) -> SendResult:
+        data.setdefault('trace', {'id': uuid.uuid4().hex, 'sent': time.monotonic()})
+        self.update_connected()
+        if not self.connected:
+            return SendResult.NO_RECEIVER
+        try:
+            frames = [topic(data['kind'])] + encode_frames(data, bus_codec)
+            self.socket.send_multipart(frames, flags= zmq.NOBLOCK, copy= False)
+            return SendResult.SENT
+        except zmq.Again:
+            return SendResult.QUEUE_FULL
+        except zmq.ZMQError as e:
+            print(e)
+            return SendResult.ERROR
+
+    def close(self):
+        self.socket.disable_monitor()
+        self.monitor.close()
+        self.socket.close()
+
+class Subscriber():
+    """
+    Receives messages of the subscribed kinds from the bus. topics = None
+    subscribes to everything.
+    """
+    def __init__(self, topics = None, hwm = None):
+        self.socket = get_context().socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, default_hwm if hwm is None else hwm)
+        self.socket.connect(f'tcp://127.0.0.1:{ports["bus_out"]}')
+        if topics is None:
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+        else:
+            for kind in topics:
+                self.subscribe(kind)
+
+    def subscribe(self, kind):
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic(kind))
+
+    def unsubscribe(self, kind):
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, topic(kind))
+
+    def poll(self, timeout = None) -> bool:
+        if timeout is not None:
+            timeout = int(timeout*1000)
+        return self.socket.poll(timeout, zmq.POLLIN) != 0
+
+    def recv(self, timeout = 0) -> typing.List[typing.Dict]:
+        """
+        Same as Server.recv
+        """
+        if timeout != 0 and not self.poll(timeout):
+            return []
+        result = []
+        while True:
+            try:
+                frames = self.socket.recv_multipart(flags= zmq.NOBLOCK, copy= False)
+            except zmq.ZMQError as e:
+                return result
+            try:
+                data = decode_frames(frames[1:])
+            except Exception as e:
+                print(f'Failed to decode message: {e}')
+                continue
+            trace = data.setdefault('trace', {})
+            trace['peer'] = None
+            trace['received'] = time.monotonic()
+            result.append(data)
+
+    def __iter__(self):
+        while True:
+            for msg in self.recv(timeout = None):
+                yield msg
+
+    def close(self):
+        self.socket.close()
+
+if __name__ == '__main__':
+    try:
+        broker = Broker()
+    except zmq.ZMQError as e:
+        print(f'Could not start the bus broker, is one already running? ({e})')
+    else:
+        print(f'Bus broker running on {ports["bus_in"]} -> {ports["bus_out"]}')
+        broker.start()
+        try:
+            while broker.thread.is_alive():
+                broker.thread.join(0.5) #Wake up now and then so Ctrl+C gets through
+        except KeyboardInterrupt:
+            pass
+        broker.stop()
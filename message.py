@@ -1,13 +1,15 @@
+import os
 import re
+import time
+import array
+import concurrent.futures
 
-import requests
 import tts
+import audio
 import filters
 
 from pydub import AudioSegment
-from pydub.playback import play
 import pydub.effects as fx
-import pydub.playback as playback
 
 ########################
 # Twitch Chat Messages #
@@ -15,27 +17,149 @@ import pydub.playback as playback
 
 #TODO: Classes for managing twitch chat messages and their metadata
 
-class CustomFilter():
-    filemap = {
-        'BibleThump': 'emote_sounds/kefka.mp3'
-    }
-    def process(self, snippet):
-        if not isinstance(snippet, tts.EmoteSnippet): return False
+def play(clip):
+    """
+    pydub.playback goes looking for an audio backend when it's imported, so
+    only import it once something actually plays
+    """
+    from pydub.playback import play as pydub_play
+    pydub_play(clip)
+
+def render_snippets(snippets, pool = None):
+    """
+    Render snippets in order, in parallel if there's a RenderPool
+    """
+    if pool is not None:
+        return pool.render(snippets)
+    return [snippet.render() for snippet in snippets]
+
+#Renders snippets one at a time in the background when there's no RenderPool
+render_thread = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+class ClipStream():
+    """
+    The clips of a list of snippets, yielded in order as soon as each one is
+    rendered. Rendering starts right away and keeps going ahead of whatever
+    is iterating. Stops early once max_duration seconds have been yielded,
+    cutting off the clip that crosses it and cancelling whatever hasn't
+    rendered yet, and sets exceeded.
+    """
+    def __init__(self, snippets, pool = None, max_duration = None, timings = None):
+        self.max_duration = max_duration
+        self.exceeded = False
+        self.timings = {} if timings is None else timings
+        self.start = time.monotonic()
+        if pool is not None:
+            self.futures = pool.submit(snippets)
+        else:
+            self.futures = [render_thread.submit(x.render) for x in snippets]
+
+    def __iter__(self):
+        duration = 0
+        first = True
+        for idx, future in enumerate(self.futures):
+            clip = future.result()
+            if clip is None: continue
+            if first:
+                self.timings['first_clip'] = time.monotonic()-self.start
+                first = False
+            if self.max_duration is not None and duration+clip.duration_seconds > self.max_duration:
+                self.exceeded = True
+                self.cancel(idx)
+                fmt = audio.get_format(clip)
+                data = audio.truncate(audio.to_array(clip), self.max_duration-duration, fmt)
+                if len(data) > 0:
+                    yield audio.to_segment(data, fmt)
+                return
+            duration += clip.duration_seconds
+            yield clip
+        self.timings['render'] = time.monotonic()-self.start
+
+    def cancel(self, idx = 0):
+        for future in self.futures[idx:]:
+            future.cancel()
+
+class BaseMessage():
+    """
+    Something that can be rendered to a clip and played. Rendering and playing
+    are separate so the next message can render while this one plays. How
+    long each took ends up in self.timings.
+    """
+    player = None #Function to play clips with instead of pydub, e.g. to benchmark without a sound card
+
+    def __init__(self):
+        self.timings = {} #stage: seconds
+        self.speed = 1    #How much faster than normal to read, set before rendering
+
+    def estimate_duration(self):
+        """
+        A cheap guess at how many seconds this will play for at normal speed
+        """
+        return 0
 
-        filename = self.filemap.get(snippet.data['emote_name'], None)
-        if filename == None: return False
+    def render(self):
+        """
+        Return the clip to play, or None if there's nothing to play
+        """
+        return None
 
-        return [tts.Mp3Snippet({'filename': filename})]
+    def play_clip(self, clip):
+        """
+        Play a clip from render, which might be a ClipStream. For a stream,
+        time spent waiting on renders goes in 'stall' rather than 'play'.
+        """
+        if clip is None: return False
+        player = play if self.player is None else type(self).player
+        if not isinstance(clip, ClipStream):
+            start = time.monotonic()
+            player(clip)
+            self.timings['play'] = time.monotonic()-start
+            return True
+
+        played = 0
+        start = time.monotonic()
+        for piece in clip:
+            piece_start = time.monotonic()
+            player(piece)
+            played += time.monotonic()-piece_start
+        self.timings['play'] = played
+        self.timings['stall'] = time.monotonic()-start-played
+        return True
+
+    def play(self, **kwargs):
+        return self.play_clip(self.render(**kwargs))
+
+class AIMessage(BaseMessage):
+    render_pool = None #Set to a render_pool.RenderPool to render voices in parallel
 
-class AIMessage():
     def __init__(self, text):
-        self.snippet = tts.AISpeechSnippet({'text':text})
+        super().__init__()
+        self.snippet = tts.AISpeechSnippet(text)
         
-    def play(self, **kwargs):
-        clip = self.snippet.render()
-        play(clip)
+    def estimate_duration(self):
+        return self.snippet.estimate_duration()
 
-class Message():
+    def render(self, **kwargs):
+        start = time.monotonic()
+        clip = render_snippets([self.snippet.with_speed(self.speed)], self.render_pool)[0]
+        self.timings['render'] = time.monotonic()-start
+        return clip
+
+class ClipMessage(BaseMessage):
+    """
+    Audio that was already rendered somewhere else
+    """
+    def __init__(self, clip):
+        super().__init__()
+        self.clip = clip
+
+    def estimate_duration(self):
+        return self.clip.duration_seconds
+
+    def render(self, **kwargs):
+        return self.clip
+
+class Message(BaseMessage):
     """
     A message
     """
@@ -44,20 +168,26 @@ class Message():
     announce_new_speakers = True #Announce the speaker when the speaker changes
 
     max_message_duration = 30 # in seconds
+    estimate_margin = 1.25    #How far over max_message_duration the estimate can go, since it's rough
+
+    render_pool = None #Set to a render_pool.RenderPool to render snippets in parallel
+    stream = True      #Start playing as soon as the first snippet is rendered
 
     filters = [
         filters.ModemReplace( # replaces urls
             'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+',
-            tts.SpeechSnippet({'text': 'URL Removed'})),
+            tts.SpeechSnippet('URL Removed')),
+        filters.RuleFilter.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'filter_rules.json')),
         filters.TooLongTruncate(30),
-        CustomFilter(),
     ]
+    filter_chain = None #filters compiled into a filters.FilterChain, built on first use
 
     def __init__(self, msg, tags, history, play_kwargs = {}):
         """
         msg and tags come from the chatbot
         history the previous {msg: msg, tags:tags}
         """
+        super().__init__()
         self.msg = msg
         self.tags = tags
         self.play_kwargs = play_kwargs
@@ -67,8 +197,7 @@ class Message():
         if history is not None:
             self.past_user = User(**history)
 
-        self.emote_data = self.parse_emotes()
-        #TODO: Extract emote data
+        self.emote_ids, self.emote_ranges = self.parse_emotes()
 
         #TODO: Extract flags data
 
@@ -76,48 +205,85 @@ class Message():
         self.snippets = self.process(self.snippets)
         self.snippets = self.postprocess(self.snippets)
 
-    def play(self, reverse=False, fade=False):
+    def render(self, reverse=False, fade=False):
         """
-        Play the message
+        Render the message, or return None if it's too long.
+
+        Messages that are estimated to run past max_message_duration by more
+        than estimate_margin are skipped before anything is rendered. Past
+        that, it's up to the actual render: when streaming, this returns a
+        ClipStream right away and the message is cut off at the limit.
+        reverse and fade need the whole clip, so they always render it all
+        first, and skip the message if it runs over.
         """
         reverse = self.play_kwargs.pop('reverse', reverse)
         fade = self.play_kwargs.pop('fade', fade)
-        
-        clip = AudioSegment.empty()
-        for snippet in self.snippets:
-            tclip = snippet.render()
-            if tclip != None:
-                clip += tclip
-        if clip.duration_seconds > self.max_message_duration:
-            return False
 
+        snippets = self.snippets
+        if self.speed != 1:
+            snippets = [x.with_speed(self.speed) for x in snippets]
+
+        if self.over_budget(snippets, self.max_message_duration*self.estimate_margin):
+            return None
+
+        if self.stream and not (reverse or fade):
+            return ClipStream(snippets, self.render_pool, self.max_message_duration, self.timings)
+
+        start = time.monotonic()
+        stream = ClipStream(snippets, self.render_pool, self.max_message_duration, self.timings)
+        clips = list(stream)
+        self.timings['render'] = time.monotonic()-start
+        if stream.exceeded:
+            return None
+
+        data, fmt = audio.concatenate_clips(clips)
         if reverse:
-            clip = clip.reverse()
+            data = audio.reverse(data)
         if fade:
-            clip = clip.fade_out(int(clip.duration_seconds*1000))
+            data = audio.fade_out(data, fmt)
 
 #        if self.check_highlighted(tags):
 #            clip = fx.speedup(clip)
 #            clip = fx.low_pass_filter(clip, 500)
 
-        play(clip)
-        return True
+        return audio.to_segment(data, fmt)
+
+    def estimate_duration(self):
+        return sum(x.estimate_duration() for x in self.snippets)
+
+    def over_budget(self, snippets, limit):
+        """
+        True if the snippets are estimated to run past limit seconds, going
+        by estimated durations before anything is rendered
+        """
+        total = 0
+        for snippet in snippets:
+            total += snippet.estimate_duration()
+            if total > limit:
+                return True
+        return False
 
 
 
     def parse_emotes(self):
+        """
+        The emote id of each emote in the message, and their first and last
+        character indices as one flat array of ints (left, right, left,
+        right...), both in order
+        """
         emotes = self.tags.get('emotes', None)
-        if emotes is None: return []
+        if emotes is None: return (), array.array('i')
         result = []
         kinds = emotes.split('/')
         for kind in kinds:
             kind, ranges = kind.split(':')
-            king = int(kind)
             ranges = ranges.split(',')
             for left, right in map(lambda x: x.split('-'), ranges):
-                result.append({'kind': kind, 'left': int(left), 'right': int(right)})
-        result = sorted(result, key=lambda x: x['left'])
-        return result
+                result.append((int(left), int(right), kind))
+        result.sort()
+        ids = tuple(x[2] for x in result)
+        ranges = array.array('i', [y for x in result for y in x[:2]])
+        return ids, ranges
 
     def preprocess(self):
         """
@@ -128,22 +294,18 @@ class Message():
 
         #handle emotes
         if emotes is None or not self.extract_emotes: 
-            result = [tts.SpeechSnippet({'text': text.strip()})]
+            result = [tts.SpeechSnippet(text.strip())]
         else:
             result = []
-            emotes = self.parse_emotes()
-            diff = 0
-            for emote in emotes:
-                textl = text[:emote['left']-diff]
-                textr = text[emote['right']+1-diff:]
-
-                emote['text'] = text[emote['left']-diff:emote['right']-diff+1]
-                diff += len(text)-len(textr)
-                text = textr
-                result.append(tts.SpeechSnippet({'text': textl.strip()}))
-                result.append(tts.EmoteSnippet({'emote_name': emote['text']}))
-            if len(textr.strip()) > 0:
-                result.append(tts.SpeechSnippet({'text': textr.strip()}))
+            ranges = self.emote_ranges
+            last = 0
+            for idx in range(0, len(ranges), 2):
+                left, right = ranges[idx], ranges[idx+1]
+                result.append(tts.SpeechSnippet(text[last:left].strip()))
+                result.append(tts.EmoteSnippet(text[left:right+1]))
+                last = right+1
+            if len(text[last:].strip()) > 0:
+                result.append(tts.SpeechSnippet(text[last:].strip()))
 
         return result
 
@@ -151,32 +313,50 @@ class Message():
         """
         Keep applying filters until there's nothing left to apply.
         """
-        max_depth = 10
-        depth = 0
-        done = False
-        while not done and depth < max_depth:
-            done = True
-            depth += 1
-            for idx, snippet in enumerate(result):
-                for filt in self.filters:
-                    tsnips = filt.process(snippet)
-                    if tsnips != False:
-                        result[idx:idx+1] = tsnips
-                        done = False
-                        break
-        return result
+        return self.get_filter_chain().process(result)
+
+    @classmethod
+    def get_filter_chain(cls):
+        """
+        The FilterChain for filters, rebuilt if filters has changed
+        """
+        chain = cls.filter_chain
+        if chain is None or chain.filters != tuple(cls.filters):
+            chain = filters.FilterChain(cls.filters)
+            cls.filter_chain = chain
+        return chain
             
 
     def postprocess(self, result):
         """
         Executed after all filters are done
         """
-        if self.announce_new_speakers:
-            if self.past_user is None or self.past_user.id != self.user.id:
-                result.insert(0, tts.SpeechSnippet({'text': self.user.display_name}, {'max_length': 1}))
+        self.named = self.is_new_speaker()
+        if self.named:
+            result.insert(0, self.name_snippet())
        
         return result
 
+    def is_new_speaker(self):
+        return self.announce_new_speakers and (self.past_user is None or self.past_user.id != self.user.id)
+
+    def name_snippet(self):
+        return tts.SpeechSnippet(self.user.display_name, {'max_length': 1})
+
+    def set_past_user(self, past_user):
+        """
+        Change who was heard before this message, adding or removing the
+        speaker's name to match. For when the sender's history can't be
+        trusted to be what was actually played.
+        """
+        self.past_user = past_user
+        named = self.is_new_speaker()
+        if named and not self.named:
+            self.snippets.insert(0, self.name_snippet())
+        elif self.named and not named:
+            del self.snippets[0]
+        self.named = named
+
 
 #############
 # User Info #
@@ -188,14 +368,16 @@ class Message():
 
 class User():
     """
-    A user as identified by twitch message tag info
+    A user as identified by twitch message tag info. Every message makes one
+    or two of these, so they use __slots__ and only parse badges if asked.
     """
+    __slots__ = ('msg', 'tags', 'id', 'display_name', 'configs', '_badges')
 
     #Maps lists of badge names to user broader classes.
     #For example anyone with a broadcaster, admin, or moderator badge is a mod
     user_classes = {
-    'mod': ['broadcaster', 'admin', 'moderator'],
-    'sub': ['subscriber'],
+    'mod': frozenset(['broadcaster', 'admin', 'moderator']),
+    'sub': frozenset(['subscriber']),
     }
 
     def __init__(self, msg, tags):
@@ -204,42 +386,40 @@ class User():
 
         self.id = tags.get('user-id') 
         self.display_name = tags.get('display-name')
-    
-        self.badges = []
-        tag_badges = tags.get('badges', [])
-        if tag_badges is not None:
-            for b in tag_badges:
-                self.badges.append(b.split('/'))
+        self._badges = None
 
         self.configs = {}
+
+    @property
+    def badges(self):
+        """
+        The frozenset of badge names, without versions, parsed from a tag
+        like 'moderator/1,subscriber/12' the first time it's needed
+        """
+        if self._badges is None:
+            tag_badges = self.tags.get('badges', None) or ''
+            if isinstance(tag_badges, str):
+                tag_badges = tag_badges.split(',')
+            self._badges = frozenset(x.split('/')[0] for x in tag_badges if x != '')
+        return self._badges
     
     def get_class(self, classname):
         """
         Return True if a user is in the desired class
         """
-        classes = self.user_classes[classname]
-        for b in self.badges:
-            if b[0] in classes: return True
-        return False
-
+        return not self.user_classes[classname].isdisjoint(self.badges)
 
     def is_mod(self):
         """
         The user is a moderator, admin, or the broadcaster
         """
-        for b in self.badges:
-             if b[0] in ['broadcaster', 'admin', 'moderator']:
-                return True
-        return False
+        return self.get_class('mod')
            
     def is_sub(self):
         """
         The user is a subscriber
         """
-        for b in self.badges:
-             if b[0] in ['subscriber']:
-                return True
-        return False
+        return self.get_class('sub')
        
 
     
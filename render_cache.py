@@ -0,0 +1,214 @@
+import os
+import wave
+import hashlib
+import threading
+import collections
+
+from pydub import AudioSegment
+
+################
+# Render Cache #
+################
+
+class RenderCache():
+    """
+    Keeps rendered audio around so repeated phrases don't have to be
+    synthesized again. Recently used clips are kept in memory up to
+    max_bytes, and everything is also written to cache_dir as wav files so
+    it survives restarts. Once the disk tier goes over disk_max_bytes, the
+    least recently used files are removed until it's down to disk_trim_to of
+    that, so trimming happens now and then instead of on every write. Set
+    cache_dir to None for memory only.
+    """
+    disk_trim_to = 0.9
+
+    def __init__(self, max_bytes = 64*2**20, cache_dir = 'render_cache', disk_max_bytes = 512*2**20):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.disk_max_bytes = disk_max_bytes
+
+        self.lock = threading.Lock()
+        self.clips = collections.OrderedDict() #key: AudioSegment, least recently used first
+        self.bytes = 0
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self.added = None #A list to record (key, clip) for everything put, or None
+
+        self.disk_files = None #path: size, least recently used first, scanned on first use
+        self.disk_bytes = 0
+
+    def make_key(self, engine, text, config):
+        """
+        A stable string key for rendering text with the given engine name
+        and config
+        """
+        items = ','.join(f'{k}={v}' for k, v in sorted(config.items()))
+        return f'{engine}|{items}|{text}'
+
+    def get(self, key, count_miss = True):
+        """
+        Return the cached clip for key or None
+        """
+        with self.lock:
+            clip = self.clips.get(key, None)
+            if clip is not None:
+                self.clips.move_to_end(key)
+                self.stats['hits'] += 1
+                return clip
+
+        clip = self.read_disk(key)
+        with self.lock:
+            if clip is None:
+                if count_miss:
+                    self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self.add_memory(key, clip)
+        return clip
+
+    def put(self, key, clip, disk = True):
+        """
+        Cache clip in memory, and on disk unless disk is False
+        """
+        with self.lock:
+            self.add_memory(key, clip)
+            if self.added is not None:
+                self.added.append((key, clip))
+        if disk:
+            self.write_disk(key, clip)
+
+    def add_memory(self, key, clip):
+        size = len(clip.raw_data)
+        if size > self.max_bytes: return
+        old = self.clips.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old.raw_data)
+        self.clips[key] = clip
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, old = self.clips.popitem(last=False)
+            self.bytes -= len(old.raw_data)
+            self.stats['evictions'] += 1
+
+    def get_counts(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def add_counts(self, counts):
+        """
+        Add counts from a cache in another process, like a RenderPool worker
+        """
+        with self.lock:
+            for key, val in counts.items():
+                self.stats[key] += val
+
+    def get_stats(self):
+        with self.lock:
+            total = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+            result = dict(self.stats)
+            result['hit_rate'] = 0 if total == 0 else (total-self.stats['misses'])/total
+            result['entries'] = len(self.clips)
+            result['bytes'] = self.bytes
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.clips.clear()
+            self.bytes = 0
+
+    #############
+    # Disk tier #
+    #############
+
+    def get_path(self, key):
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, f'{name}.wav')
+
+    def read_disk(self, key):
+        if self.cache_dir is None: return None
+        path = self.get_path(key)
+        try:
+            with wave.open(path, 'rb') as fp:
+                clip = AudioSegment(
+                    data = fp.readframes(fp.getnframes()),
+                    sample_width = fp.getsampwidth(),
+                    frame_rate = fp.getframerate(),
+                    channels = fp.getnchannels(),
+                    )
+            os.utime(path) #Keep recently used files from being trimmed, after a restart too
+            with self.lock:
+                if self.disk_files is not None and path in self.disk_files:
+                    self.disk_files.move_to_end(path)
+            return clip
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'Failed to read cached render {path}: {e}')
+            return None
+
+    def write_disk(self, key, clip):
+        if self.cache_dir is None: return
+        path = self.get_path(key)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with wave.open(temp_path, 'wb') as fp:
+                fp.setsampwidth(clip.sample_width)
+                fp.setframerate(clip.frame_rate)
+                fp.setnchannels(clip.channels)
+                fp.writeframes(clip.raw_data)
+            os.replace(temp_path, path)
+        except Exception as e:
+            print(f'Failed to write cached render {path}: {e}')
+            return
+        self.trim_disk(path)
+
+    def scan_disk(self):
+        """
+        Index the files already in cache_dir, least recently used first. Call
+        with lock held.
+        """
+        found = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.wav'): continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue #Another process removed it
+            found.append((info.st_mtime, path, info.st_size))
+        self.disk_files = collections.OrderedDict()
+        self.disk_bytes = 0
+        for _, path, size in sorted(found):
+            self.disk_files[path] = size
+            self.disk_bytes += size
+
+    def trim_disk(self, new_path):
+        """
+        Add a file that was just written to the index, and trim the disk tier
+        if that put it over disk_max_bytes
+        """
+        try:
+            size = os.path.getsize(new_path)
+        except OSError:
+            return #Another process already trimmed it
+        removed = []
+        with self.lock:
+            if self.disk_files is None:
+                self.scan_disk()
+            self.disk_bytes -= self.disk_files.pop(new_path, 0)
+            self.disk_files[new_path] = size
+            self.disk_bytes += size
+            if self.disk_bytes <= self.disk_max_bytes: return
+            while len(self.disk_files) > 0 and self.disk_bytes > self.disk_max_bytes*self.disk_trim_to:
+                path, size = self.disk_files.popitem(last=False)
+                self.disk_bytes -= size
+                removed.append(path)
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,122 @@
+import os
+import concurrent.futures
+
+import tts
+import audio
+
+###############
+# Render Pool #
+###############
+
+class RenderPool():
+    """
+    Renders snippets in worker processes that each have their own tts engine,
+    so the snippets of a message (and the voices of an AISpeechSnippet) get
+    synthesized at the same time instead of one after another.
+
+    Snippets already in this process's render cache never go to a worker.
+    Workers send back what they added to their caches and their cache and
+    audio stats, so this process's cache stays warm and its stats count
+    every render.
+
+    Workers re-import the main module on windows, so anything that creates a
+    pool needs an if __name__ == '__main__' guard.
+    """
+    def __init__(self, workers = None, initializer = None, initargs = ()):
+        """
+        initializer(*initargs) runs in each worker when it starts, e.g.
+        tts.use_engine
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers = self.workers,
+            initializer = initializer,
+            initargs = initargs,
+            )
+
+    def submit(self, snippets):
+        """
+        Start rendering snippets and return a list of futures, one per
+        snippet, for the clips
+        """
+        result = []
+        for snippet in snippets:
+            parts = [self.submit_part(x) for x in snippet.split()]
+            result.append(CombinedFuture(snippet, parts))
+        return result
+
+    def submit_part(self, snippet):
+        """
+        A future for (clip, worker stats) of one part of a snippet. Cached
+        parts are done right away with no stats.
+        """
+        clip = snippet.render_cached()
+        if clip is not None:
+            future = concurrent.futures.Future()
+            future.set_result((clip, None))
+            return future
+        future = self.executor.submit(render_snippet, snippet)
+        future.add_done_callback(merge_stats)
+        return future
+
+    def render(self, snippets):
+        """
+        Render snippets in parallel and return the clips in the same order
+        """
+        return [x.result() for x in self.submit(snippets)]
+
+    def close(self):
+        self.executor.shutdown(cancel_futures = True)
+
+class CombinedFuture():
+    """
+    The rendered clip of a snippet that was split into parts
+    """
+    def __init__(self, snippet, parts):
+        self.snippet = snippet
+        self.parts = parts
+
+    def done(self):
+        return all(x.done() for x in self.parts)
+
+    def cancel(self):
+        for part in self.parts:
+            part.cancel()
+
+    def result(self):
+        return self.snippet.combine([x.result()[0] for x in self.parts])
+
+def render_snippet(snippet):
+    """
+    Runs in the worker process. Returns the clip along with the clips the
+    render added to the cache and how much the cache and audio stats went up.
+    """
+    cache = tts.TTS.cache
+    cache_before = cache.get_counts()
+    audio_before = audio.get_stats()
+    cache.added = []
+    try:
+        clip = snippet.render()
+        stats = {
+            'added': cache.added,
+            'cache': subtract(cache.get_counts(), cache_before),
+            'audio': subtract(audio.get_stats(), audio_before),
+            }
+    finally:
+        cache.added = None
+    return clip, stats
+
+def subtract(after, before):
+    return {key: val - before[key] for key, val in after.items() if val != before[key]}
+
+def merge_stats(future):
+    """
+    Add what a worker rendered to this process's cache and stats. The worker
+    already wrote its clips to the disk tier.
+    """
+    if future.cancelled() or future.exception() is not None: return
+    clip, stats = future.result()
+    for key, added in stats['added']:
+        tts.TTS.cache.put(key, added, disk = False)
+    tts.TTS.cache.add_counts(stats['cache'])
+    audio.add_stats(stats['audio'])
@@ -136,7 +136,7 @@ class Handler():
         
 handler = Handler()
 
-ipc_server = ipc.Server(7852)
+ipc_server = ipc.Server(ipc.ports['overlay'], topics = ['new_map', 'log'])
 
 def script_unload():
     print('Unloading')
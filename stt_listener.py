@@ -15,7 +15,7 @@ def filter_language(text):
 class STT():
     def __init__(self):
         
-        self.overlay = ipc.OverlayClient()
+        self.bus = ipc.Publisher()
         self.tts = ipc.TTSClient()
 
         for index, name in enumerate(sr.Microphone.list_microphone_names()[:4]):
@@ -73,7 +73,7 @@ class STT():
                 
                 result = filter_language(result)
                 
-                self.overlay.send_log(message = f'{conf*100:.0f} "{result}"', level= 'model')
+                self.bus.send_log(message = f'{conf*100:.0f} "{result}"', level= 'model')
                 
                 self.tts.send_stt(result)
                 
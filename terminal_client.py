@@ -1,4 +1,5 @@
 import ipc
+import timing
 
 overlay = ipc.OverlayClient()
 tts = ipc.TTSClient()
@@ -20,12 +21,25 @@ while True:
         elif cmd == 'stt':
             msg = ' '.join(data)
             tts.send_stt(msg)
+        elif cmd == 'stats':
+            stats = tts.get_stats()
+            if stats is None:
+                print('No response from tts listener')
+            else:
+                print(timing.format_summary(stats['latency']))
+                print('Render cache: ' + ', '.join(f'{k}: {v}' for k, v in stats['cache'].items()))
+                print('Audio conversions: ' + ', '.join(f'{k}: {v}' for k, v in stats['audio'].items()))
+                print(f'Backlog: {stats["queue"]["backlog"]:.1f}s, reading at {stats["queue"]["speed"]}x')
+                for key in ['depth', 'scheduled', 'dropped']:
+                    print(f'Queue {key}: ' + ', '.join(f'{k}: {v}' for k, v in stats['queue'][key].items()))
+                print('Chat gate: ' + ', '.join(f'{k}: {v}' for k, v in stats['gate'].items()))
         elif cmd == 'help':
             print("""
 Commands:
   log <level> <message>
   tts <message>
   stt <message>
+  stats
   exit/quit
 """)
         elif cmd in {'exit', 'quit'}:
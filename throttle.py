@@ -0,0 +1,149 @@
+import re
+import time
+import collections
+
+############
+# Throttle #
+############
+
+"""
+Keeps chat spam from reaching the tts queue. Used from tts_listener's
+receive loop only, so nothing here is locked.
+"""
+
+class TokenBuckets():
+    """
+    A token bucket per user. Each message takes a token, and tokens come back
+    at rate per second up to burst. Only the max_users most recently seen
+    users are remembered; anyone older starts over with a full bucket.
+    """
+    def __init__(self, rate = 0.2, burst = 3, max_users = 1000):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = collections.OrderedDict() #user id: (tokens, last update)
+
+    def allow(self, user_id, now = None):
+        now = time.monotonic() if now is None else now
+        tokens, last = self.buckets.pop(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now-last)*self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[user_id] = (tokens, now)
+        if len(self.buckets) > self.max_users:
+            self.buckets.popitem(last=False)
+        return allowed
+
+class Deduplicator():
+    """
+    Remembers what was read in the last window seconds, keyed on normalized
+    text, so copies of it can be counted instead of read again. Once a
+    window closes, expired returns whatever was repeated along with how many
+    times it was seen. At most max_texts are remembered, in the order they
+    were first read (not by last use), and the first read are let go early.
+    """
+    def __init__(self, window = 30, max_texts = 500):
+        self.window = window
+        self.max_texts = max_texts
+        self.texts = collections.OrderedDict() #key: [first seen, count, data], oldest first
+        self.finished = [] #(data, count) for expired to return
+
+    def normalize(self, text):
+        """
+        Lowercase, letters and numbers only, single spaces, and runs of the
+        same character cut to two, so 'LOL!!' and 'lolll' match. Text with
+        no letters or numbers comes out empty and shouldn't be deduplicated.
+        """
+        text = re.sub(r'[^\w\s]', '', text.lower())
+        text = re.sub(r'(\w)\1{2,}', r'\1\1', text)
+        return ' '.join(text.split())
+
+    def is_copy(self, key, now = None):
+        """
+        True, and counted, if key was added less than window seconds ago
+        """
+        now = time.monotonic() if now is None else now
+        entry = self.texts.get(key, None)
+        if entry is None or now-entry[0] > self.window: return False
+        entry[1] += 1
+        return True
+
+    def add(self, key, data, now = None):
+        """
+        Start counting copies of key. data is kept for expired.
+        """
+        now = time.monotonic() if now is None else now
+        entry = self.texts.pop(key, None)
+        if entry is not None:
+            self.finish(entry)
+        self.texts[key] = [now, 1, data]
+        if len(self.texts) > self.max_texts:
+            _, entry = self.texts.popitem(last=False)
+            self.finish(entry)
+
+    def finish(self, entry):
+        if entry[1] > 1:
+            self.finished.append((entry[2], entry[1]))
+
+    def expired(self, now = None):
+        """
+        Forget texts whose window has closed, and return (data, count) for
+        the ones that were repeated
+        """
+        now = time.monotonic() if now is None else now
+        while len(self.texts) > 0:
+            key, entry = next(iter(self.texts.items()))
+            if now-entry[0] <= self.window: break
+            del self.texts[key]
+            self.finish(entry)
+        result = self.finished
+        self.finished = []
+        return result
+
+class ChatGate():
+    """
+    Decides which chat messages get read. Copies of a message that was just
+    read are dropped and counted, then announced once as announcement with
+    the first announcement_words of the message (e.g. 'pog x5'). Everything
+    else is rate limited per user unless it's exempt.
+    """
+    announcement = '{text} x{count}'
+    announcement_words = 5
+
+    def __init__(self, buckets = None, dedup = None):
+        self.buckets = TokenBuckets() if buckets is None else buckets
+        self.dedup = Deduplicator() if dedup is None else dedup
+        self.stats = {'allowed': 0, 'duplicates': 0, 'rate_limited': 0, 'announced': 0}
+
+    def allow(self, data, exempt = False, now = None):
+        """
+        data is a send_chat payload. True if it should be read.
+        """
+        key = self.dedup.normalize(data['msg'])
+        if key != '' and self.dedup.is_copy(key, now):
+            self.stats['duplicates'] += 1
+            return False
+        if not exempt and not self.buckets.allow(data['tags'].get('user-id'), now):
+            self.stats['rate_limited'] += 1
+            return False
+        if key != '':
+            self.dedup.add(key, data, now)
+        self.stats['allowed'] += 1
+        return True
+
+    def announcements(self, now = None):
+        """
+        send_chat payloads announcing how many times repeated messages were
+        sent, from the same user as the first copy so no name is read
+        """
+        result = []
+        for data, count in self.dedup.expired(now):
+            text = ' '.join(data['msg'].split()[:self.announcement_words])
+            history = {'msg': data['msg'], 'tags': data['tags']}
+            result.append({'msg': self.announcement.format(text=text, count=count), 'tags': data['tags'], 'history': history})
+            self.stats['announced'] += 1
+        return result
+
+    def get_stats(self):
+        return dict(self.stats, users=len(self.buckets.buckets), texts=len(self.dedup.texts))
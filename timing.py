@@ -0,0 +1,88 @@
+import time
+import math
+import threading
+import collections
+import contextlib
+
+#################
+# Latency Stats #
+#################
+
+class Histogram():
+    """
+    A rolling window of samples that can report percentiles
+    """
+    def __init__(self, size = 1000):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def percentile(self, p):
+        """
+        Nearest-rank percentile of the current window, p in 0-100
+        """
+        if len(self.samples) == 0: return None
+        ordered = sorted(self.samples)
+        idx = max(0, math.ceil(p/100*len(ordered))-1)
+        return ordered[idx]
+
+    def summary(self):
+        return {
+            'count': len(self.samples),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': max(self.samples, default=None),
+            }
+
+class Tracer():
+    """
+    Records how long each stage took for each traced message, keeping a
+    rolling histogram per stage and the full breakdown of recent messages.
+    Times are in seconds.
+    """
+    def __init__(self, window = 1000, keep = 100):
+        self.window = window
+        self.keep = keep
+        self.stages = {} #stage: Histogram
+        self.traces = collections.OrderedDict() #trace id: {stage: seconds}
+        self.lock = threading.Lock()
+
+    def record(self, trace_id, stage, seconds):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(self.window)
+            self.stages[stage].add(seconds)
+
+            if trace_id is None: return
+            self.traces.setdefault(trace_id, {})[stage] = seconds
+            self.traces.move_to_end(trace_id)
+            while len(self.traces) > self.keep:
+                self.traces.popitem(last=False)
+
+    @contextlib.contextmanager
+    def span(self, trace_id, stage):
+        """
+        Record the time spent in a with block
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(trace_id, stage, time.monotonic()-start)
+
+    def summary(self):
+        with self.lock:
+            return {stage: hist.summary() for stage, hist in self.stages.items()}
+
+def format_summary(summary):
+    """
+    Render a Tracer summary as a table in milliseconds
+    """
+    def ms(x):
+        return '-' if x is None else f'{x*1000:.1f}'
+    lines = [f'{"stage":>12} {"count":>6} {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}']
+    for stage, stats in summary.items():
+        lines.append(f'{stage:>12} {stats["count"]:>6} ' + ' '.join(f'{ms(stats[x]):>8}' for x in ['p50', 'p95', 'p99', 'max']))
+    return '\n'.join(lines)
@@ -1,12 +1,18 @@
-from gtts import gTTS
-import pyttsx3
+import io
 import os
 import time
+import wave
+import zlib
+import tempfile
+import threading
+
+import numpy as np
 
 from pydub import AudioSegment
-from pydub.playback import play
 import pydub.effects as fx
-import pydub.playback as playback
+
+import render_cache
+import audio
 
 ###############
 # TTS Engines #
@@ -16,7 +22,10 @@ class TTS():
     """
     TTS wrapper class for abstracting different TTS libraries
     """
-    temp_file_path = 'temp.mp3'
+    #Where to put temporary files for engines that can only write to files.
+    #None uses the system default.
+    temp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    cache = render_cache.RenderCache() #Shared by every engine, keyed by engine name
 
     default_configs = { 
         }
@@ -24,20 +33,34 @@ class TTS():
     config_options = {
         #name: {'description': 'text', permissions: [user types]}
         }
+    chars_per_second = 15 #Rough speaking speed at the default rate, for estimate_duration
 
     def __init__(self):
         pass
 
-    def get_instance_config(self, config):
+    @classmethod
+    def get_instance_config(cls, config):
         """
         Update default configs with permitted configs
         """
-        instance_config = dict(self.default_configs)
+        instance_config = dict(cls.default_configs)
         for key, val in config.items():
-            if key in self.config_options.keys():
+            if key in cls.config_options.keys():
                 instance_config[key] = config[key]
         return instance_config
 
+    @classmethod
+    def estimate_duration(cls, text, config = {}):
+        """
+        A rough guess at how many seconds text will take to say, without
+        creating the engine or rendering anything
+        """
+        instance_config = cls.get_instance_config(config)
+        speed = cls.chars_per_second
+        if 'rate' in cls.default_configs:
+            speed *= float(instance_config['rate'])/cls.default_configs['rate']
+        return len(text)/speed
+
     def get_config_options(self, config):
         lines = []
         lines.append('TTS Configuration Options:')
@@ -47,17 +70,44 @@ class TTS():
         return ' | '.join(lines)
 
 
-    def render(self, text, config):
+    def render(self, text, config = {}, cache = True):
         """
         Return an AudioSegment of the given text rendered to speech subject to
-        optional configurations in kwargs
+        optional configurations in config, in audio.canonical format. Renders
+        are cached unless cache is False.
         """
-        raise NotImplemented()
+        instance_config = self.get_instance_config(config)
+        if not cache:
+            return audio.to_canonical(self.synthesize(text, instance_config))
+
+        key = self.cache.make_key(type(self).__name__, text, instance_config)
+        clip = self.cache.get(key)
+        if clip is None:
+            clip = audio.to_canonical(self.synthesize(text, instance_config))
+            self.cache.put(key, clip)
+        return clip
+
+    @classmethod
+    def get_cached(cls, text, config = {}):
+        """
+        The cached render of text or None, without creating the engine, so
+        this works in a process whose engines live in RenderPool workers. A
+        miss isn't counted, since whatever renders it looks it up again.
+        """
+        key = cls.cache.make_key(cls.__name__, text, cls.get_instance_config(config))
+        return cls.cache.get(key, count_miss = False)
+
+    def synthesize(self, text, instance_config):
+        """
+        Actually render text to an AudioSegment with the full instance config
+        """
+        raise NotImplementedError()
 
 class GTTS(TTS):
     default_configs = {
         'lang': 'en',
         }
+    chars_per_second = 14
     config_options = {
         'lang': {
             'description': 'The TTS language code',
@@ -66,11 +116,12 @@ class GTTS(TTS):
     }
 
 
-    def render(self, text, config = {}):
-        instance_config = self.get_instance_config(config)
-
-        gTTS(text, **instance_config).save(self.temp_file_path)
-        clip = AudioSegment.from_mp3(self.temp_file_path)
+    def synthesize(self, text, instance_config):
+        from gtts import gTTS
+        fp = io.BytesIO()
+        gTTS(text, **instance_config).write_to_fp(fp)
+        fp.seek(0)
+        clip = AudioSegment.from_file(fp, format='mp3')
         return clip 
 
         
@@ -79,9 +130,9 @@ class PyTTSX3(TTS):
     default_configs = {
         'rate': 200,
         'volume': 1,
-        'voice': None, #This will be replaced with the actual ID during __init__
-        'voice_name': 'zira'
+        'voice_name': 'zira' #Resolved to the engine's voice id in set_configs
         }
+    chars_per_second = 17 #rate is in words per minute
 
     config_options = {
         'rate': {'description': 'TTS reading rate', 'permissions': ['mod', 'sub']},
@@ -89,15 +140,18 @@ class PyTTSX3(TTS):
         }
 
     def __init__(self):
+        import pyttsx3
+        self.lock = threading.Lock() #The engine can only do one thing at a time
         self.engine = pyttsx3.init()
         self.voices = self.engine.getProperty('voices')
 
-        voice_id = self.get_voice(
+        #Kept on the instance rather than in default_configs, so render cache
+        #keys are the same in processes that never create an engine
+        self.default_voice = self.get_voice(
             self.default_configs['voice_name'], 
             self.engine.getProperty('voice')
             )
 
-        self.default_configs['voice'] = voice_id
         print([x.name for x in self.voices])
         print(self.engine.getProperty('voice'))
 
@@ -122,46 +176,179 @@ class PyTTSX3(TTS):
         return result.id
 
     def set_configs(self, config):
-        if config['voice_name'] != self.default_configs['voice_name']:
-            config['voice'] = self.get_voice(config['voice_name'], self.default_configs['voice'])
-        for prop, val in config.items():
+        props = dict(config)
+        voice_name = props.pop('voice_name')
+        props['voice'] = self.default_voice
+        if voice_name != self.default_configs['voice_name']:
+            props['voice'] = self.get_voice(voice_name, self.default_voice)
+        for prop, val in props.items():
             try:
 #                old = self.engine.getProperty(prop)
                 self.engine.setProperty(prop, val)
             except Exception as e:
                 print(f'Failed to set pyttsx engine property {prop} to {val}:\n{e}')
 
-    def render(self, text, config = {}):
-        instance_config = self.get_instance_config(config)   
-        self.set_configs(instance_config)
-        self.engine.save_to_file(text, self.temp_file_path)
-        self.engine.runAndWait()
-        time.sleep(0.05) #sometimes the file doesn't get updated before trying to read it?
-        clip = AudioSegment.from_wav(self.temp_file_path)
-        return clip
+    def synthesize(self, text, instance_config):
+        fd, path = tempfile.mkstemp(suffix='.wav', dir=self.temp_dir)
+        os.close(fd)
+        try:
+            with self.lock:
+                self.set_configs(instance_config)
+                self.engine.save_to_file(text, path)
+                self.engine.runAndWait()
+            return read_finished_wav(path)
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def read_finished_wav(path, timeout = 1):
+    """
+    Read a wav file that an engine might still be finishing. The file is done
+    when its header agrees with the amount of data in it, or when it's empty
+    and has stopped changing.
+    """
+    deadline = time.monotonic() + timeout
+    last_size = None
+    while True:
+        size = os.path.getsize(path)
+        try:
+            with wave.open(path, 'rb') as fp:
+                expected = fp.getnframes()*fp.getsampwidth()*fp.getnchannels()
+                data = fp.readframes(fp.getnframes())
+                if len(data) == expected and (expected > 0 or size == last_size):
+                    return AudioSegment(
+                        data = data,
+                        sample_width = fp.getsampwidth(),
+                        frame_rate = fp.getframerate(),
+                        channels = fp.getnchannels(),
+                        )
+        except (EOFError, wave.Error):
+            pass #Header isn't there yet
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{path} was never finished')
+        last_size = size
+        time.sleep(0.001)
+
+class SyntheticTTS(TTS):
+    """
+    A deterministic stand-in for a real engine, for benchmarking everything
+    around the engine on machines that can't run one. Renders a tone whose
+    pitch depends on the voice and whose length scales with the length of the
+    text and the rate, after sleeping latency + latency_per_char*len(text)
+    seconds to stand in for synthesis time.
+    """
+    default_configs = {
+        'rate': 200,
+        'volume': 1,
+        'voice_name': 'zira',
+        'frame_rate': 22050,
+        'seconds_per_char': 0.06, #at rate 200
+        'latency': 0,
+        'latency_per_char': 0,
+        }
+
+    config_options = PyTTSX3.config_options
+
+    @classmethod
+    def estimate_duration(cls, text, config = {}):
+        config = cls.get_instance_config(config)
+        return len(text)*config['seconds_per_char']*200/float(config['rate'])
+
+    def synthesize(self, text, instance_config):
+        config = instance_config
+        time.sleep(config['latency'] + config['latency_per_char']*len(text))
+
+        frame_rate = config['frame_rate']
+        seconds = len(text)*config['seconds_per_char']*200/float(config['rate'])
+        freq = 100 + zlib.crc32(str(config['voice_name']).encode()) % 400
+        t = np.arange(int(seconds*frame_rate))/frame_rate
+        data = (np.sin(2*np.pi*freq*t)*float(config['volume'])*0x3fff).astype('<i2')
+        return AudioSegment(data=data.tobytes(), sample_width=2, frame_rate=frame_rate, channels=1)
+
+###################
+# Engine Registry #
+###################
+
+"""
+Engines are slow to start (pyttsx3 enumerates every voice), so they're only
+created the first time something renders with them.
+"""
+
+engine_classes = {
+    'pyttsx3': PyTTSX3,
+    'gtts': GTTS,
+    'synthetic': SyntheticTTS,
+    }
+
+engines = {} #name: engine instance
+engine_lock = threading.Lock()
+
+def get_engine(name):
+    """
+    Return the engine registered as name, creating it if needed
+    """
+    with engine_lock:
+        if name not in engines:
+            engines[name] = engine_classes[name]()
+        return engines[name]
+
+class LazyEngine():
+    """
+    A class attribute that turns into the named engine when it's first used
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, owner = None):
+        return get_engine(self.name)
+
+    def get_class(self):
+        return engine_classes[self.name]
+
+def use_engine(name, configs = None):
+    """
+    Make every snippet render with the named engine, optionally overriding
+    its default configs. Also works as a RenderPool initializer so the
+    workers match.
+    """
+    if configs is not None:
+        engine_classes[name].default_configs.update(configs)
+    Snippet.tts_engine = LazyEngine(name)
 
 ####################
 # Message Snippets #
 ####################
 
+default_config = {'voice_name':'zira'} #Shared by every snippet that isn't given a config
+
 class Snippet():
     """
     A class for representing the mapping of a message segment into audio. Also
     contains global configurations such as the tts engine to use for all tts
     rendering.
+
+    There's one of these for every piece of every chat message, so they use
+    __slots__ and keep their content in named fields (listed in fields)
+    instead of a dict.
     """
+    __slots__ = ('config',)
+    fields = ()             #content fields, in constructor order
     muted = False           #per-class mute setting. When mute is true, render should return None
-    tts_engine = PyTTSX3()  #The default tts engine to use
+    tts_engine = LazyEngine('pyttsx3') #The default tts engine to use
 
-    def __init__(self, data, config = {'voice_name':'zira'}):
+    def __init__(self, config = default_config):
         """
-        Data is the message snippet content and relevant metadata
         Config is a dictionary with parameters to be used for rendering the 
-        audio output.
+        audio output. 'cache': False skips the render cache. It's shared, so
+        don't change it in place.
         """
-        self.data = data
         self.config = config
 
+    def __repr__(self):
+        return f'{type(self).__name__} : ' + ', '.join(str(getattr(self, x)) for x in self.fields)
+
     def render(self):
         """
         Return an AudioSegment representing this snippet or None if there is no
@@ -169,8 +356,59 @@ class Snippet():
         """
         return None
 
+    def render_cached(self):
+        """
+        The render if it's in the render cache, otherwise None. Never
+        synthesizes anything.
+        """
+        return None
+
+    def split(self):
+        """
+        Return a list of snippets that can be rendered independently (and in
+        parallel) and then put back together with combine
+        """
+        return [self]
+
+    def combine(self, clips):
+        """
+        Put the renders of the snippets from split back together
+        """
+        return clips[0]
+
+    @classmethod
+    def engine_class(cls):
+        """
+        The class of tts_engine, without creating the engine
+        """
+        for klass in cls.__mro__:
+            engine = vars(klass).get('tts_engine', None)
+            if isinstance(engine, LazyEngine):
+                return engine.get_class()
+            if engine is not None:
+                return type(engine)
+
+    def estimate_duration(self):
+        """
+        A cheap guess at how many seconds the render will be, without
+        rendering. 0 if there's no way to tell.
+        """
+        return 0
+
+    def with_speed(self, factor):
+        """
+        A snippet that reads factor times faster, or this one if it can't
+        """
+        return self
+
 class SpeechSnippet(Snippet):
+    __slots__ = ('text',)
+    fields = ('text',)
     muted = False
+
+    def __init__(self, text, config = default_config):
+        super().__init__(config)
+        self.text = text
     
     def render(self):
         if self.muted: return None
@@ -178,89 +416,219 @@ class SpeechSnippet(Snippet):
         config = dict(self.config)
 
         max_length = config.pop('max_length', None)
-        clip = self.tts_engine.render(self.data['text'], self.config)
+        cache = config.pop('cache', True)
+        clip = self.tts_engine.render(self.text, config, cache)
+        return self.shorten(clip, max_length)
+
+    def render_cached(self):
+        if self.muted: return None
+
+        config = dict(self.config)
+
+        max_length = config.pop('max_length', None)
+        if not config.pop('cache', True): return None
+        clip = self.engine_class().get_cached(self.text, config)
+        return self.shorten(clip, max_length)
+
+    def shorten(self, clip, max_length):
+        """
+        Cut clip to max_length seconds if there's a max_length
+        """
+        if clip is None or max_length is None: return clip
+        fmt = audio.get_format(clip)
+        return audio.to_segment(audio.truncate(audio.to_array(clip), max_length, fmt), fmt)
+
+    def estimate_duration(self):
+        if self.muted: return 0
+        config = dict(self.config)
+        max_length = config.pop('max_length', None)
+        estimate = self.engine_class().estimate_duration(self.text, config)
         if max_length != None:
-            clip = clip[:int(max_length*1000)]
-        
-            
-        return clip
+            estimate = min(estimate, max_length)
+        return estimate
+
+    def with_speed(self, factor):
+        """
+        Scale the rate, if the engine has one
+        """
+        engine = self.engine_class()
+        if factor == 1 or 'rate' not in engine.config_options: return self
+        rate = self.config.get('rate', engine.default_configs['rate'])
+        return type(self)(self.text, dict(self.config, rate=int(round(float(rate)*factor))))
 
     def __repr__(self):
-        return f'SpeechSnippet : {self.data["text"]}'
+        return f'SpeechSnippet : {self.text}'
 
 class AISpeechSnippet(SpeechSnippet):
+    __slots__ = ()
+    voices = ['david', 'zira']
+
     def render(self):
         if self.muted: return None
+        return self.combine([x.render() for x in self.split()])
 
-        config = dict(self.config)
-
-        clips = []
-        for voice in ['david', 'zira']:
+    def split(self):
+        """
+        One SpeechSnippet per voice
+        """
+        result = []
+        for voice in self.voices:
+            config = dict(self.config)
             config['voice_name'] = voice
-            clips.append(self.tts_engine.render(self.data['text'], config))
-            
-        clip = None
-        for tclip in clips:
-            if clip is None:
-                clip = tclip
-            else:
-                longer = max(clip, tclip, key=lambda x: len(x))
-                shorter = min(clip, tclip, key=lambda x: len(x))
-                clip = longer.overlay(shorter)
-        return clip
+            result.append(SpeechSnippet(self.text, config))
+        return result
+
+    def render_cached(self):
+        if self.muted: return None
+        clips = [x.render_cached() for x in self.split()]
+        if any(x is None for x in clips): return None
+        return self.combine(clips)
+
+    def combine(self, clips):
+        if self.muted: return None
+        return audio.overlay_clips(clips)
 
     def __repr__(self):
-        return f'SpeechSnippet : {self.data["text"]}'
+        return f'SpeechSnippet : {self.text}'
         
 class EmoteSnippet(Snippet):
+    __slots__ = ('emote_name',)
+    fields = ('emote_name',)
+    sound_duration = 1 #Guess for estimate_duration, since sound files aren't read until render
+
     muted = False
     emote_map = {
         'LUL':'kefka.mp3'
     }
     emote_dir = 'emote_sounds'
 
+    def __init__(self, emote_name, config = default_config):
+        super().__init__(config)
+        self.emote_name = emote_name
+
     def render(self, **kwargs):
         if self.muted: return None
-        if self.data['emote_name'] in self.emote_map.keys():
-            filename = self.emote_map[self.data['emote_name']]
+        if self.emote_name in self.emote_map.keys():
+            filename = self.emote_map[self.emote_name]
             filename = os.path.join(self.emote_dir, filename)
-            return AudioSegment.from_mp3(filename)
+            return audio.to_canonical(AudioSegment.from_mp3(filename))
         else:
-            return self.tts_engine.render(self.data['emote_name'])
+            return self.tts_engine.render(self.emote_name, cache = self.config.get('cache', True))
+
+    def render_cached(self):
+        if self.muted or self.emote_name in self.emote_map.keys(): return None
+        if not self.config.get('cache', True): return None
+        return self.engine_class().get_cached(self.emote_name)
+
+    def estimate_duration(self):
+        if self.muted: return 0
+        if self.emote_name in self.emote_map.keys():
+            return self.sound_duration
+        return self.engine_class().estimate_duration(self.emote_name)
 
     def __repr__(self):
-        return f'EmoteSnippet : {self.data["emote_name"]}'
+        return f'EmoteSnippet : {self.emote_name}'
 
 class Mp3Snippet(Snippet):
+    __slots__ = ('filename',)
+    fields = ('filename',)
     muted = False
+    sound_duration = 1 #Guess for estimate_duration
+
+    def __init__(self, filename, config = default_config):
+        super().__init__(config)
+        self.filename = filename
 
     def render(self):
-        return AudioSegment.from_mp3(self.data['filename'])
+        return audio.to_canonical(AudioSegment.from_mp3(self.filename))
+
+    def estimate_duration(self):
+        return self.sound_duration
+
+def bit_matrix(codes, width):
+    """
+    The binary digits of each code without leading zeros, like bin(code)[2:],
+    left aligned in rows of width bits. Also returns how many bits of each
+    row are used.
+    """
+    lengths = np.floor(np.log2(np.maximum(codes, 1))).astype(np.int64) + 1
+    shifts = lengths[:,None] - 1 - np.arange(width)[None,:]
+    bits = (codes[:,None] >> np.maximum(shifts, 0)) & 1
+    bits[shifts < 0] = 0
+    return bits.astype(np.uint8), lengths
 
 class ModemSnippet(Snippet):
     """
     Converts text into a bitstream via ascii and then into a sound
     """
+    __slots__ = ('text',)
+    fields = ('text',)
     muted = False
+    fs = 44100
+    sps = 16     #samples per bit
+    high = 0x40  #sample value of a 1, 0 is 0x00
+
+    waveforms = None #per-byte waveform table, built on first render
+
+    @classmethod
+    def get_waveforms(cls):
+        """
+        The waveform of every byte value, left aligned in rows of 8 bits, and
+        how many samples of each row are used
+        """
+        if cls.waveforms is None:
+            bits, lengths = bit_matrix(np.arange(256), 8)
+            cls.waveforms = (np.repeat(bits, cls.sps, axis=1)*cls.high, lengths*cls.sps)
+        return cls.waveforms
+
+    def __init__(self, text, config = default_config):
+        super().__init__(config)
+        self.text = text
 
     def render(self, **kwargs):
         if self.muted: return None
+        return audio.to_canonical(self.synthesize(**kwargs))
+
+    def estimate_duration(self, **kwargs):
+        """
+        Exact, since the signal only depends on the text
+        """
+        if self.muted: return 0
+        duration = kwargs.get('duration', 0.75)
+        text = self.text
+        if len(text) == 0: return 0
+        repeats = max(1,int(duration/(self.sps*8*len(text)/self.fs)))
+        bits = sum(max(ord(x), 1).bit_length() for x in text)
+        return repeats*bits*self.sps/self.fs
+
+    def synthesize(self, **kwargs):
+        """
+        The raw 8 bit modem signal at fs, before conversion to audio.canonical
+        """
         duration = kwargs.get('duration', 0.75)
-        count = len(self.data['text'])
-        fs = 44100
-        sps =16
-        base_dur = sps*8*count/fs
+        text = self.text
+        count = len(text)
+        if count == 0: return AudioSegment.empty()
+        base_dur = self.sps*8*count/self.fs
         repeats = max(1,int(duration/base_dur))
-        bits = []
-        for char in self.data['text']:
-            for _ in range(repeats):
-                bits.extend(list(bin(ord(char)))[2:])
-        data = []
-        for bit in bits:
-            if bit == '0': value = 0x00
-            else: value = 0x40
-            data.extend([value]*sps)
-        result = AudioSegment(data= bytes(data), sample_width=1, frame_rate = fs, channels  =1)
+
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.int64)
+        if codes.max() < 256:
+            table, table_lengths = self.get_waveforms()
+            rows = table[codes]
+            lengths = table_lengths[codes]
+        else:
+            bits, lengths = bit_matrix(codes, int(codes.max()).bit_length())
+            rows = np.repeat(bits, self.sps, axis=1)*self.high
+            lengths = lengths*self.sps
+
+        #Each character's waveform is repeated back to back, then the unused
+        #tail of each row is dropped
+        rows = np.repeat(rows, repeats, axis=0)
+        lengths = np.repeat(lengths, repeats)
+        data = rows[np.arange(rows.shape[1])[None,:] < lengths[:,None]]
+
+        result = AudioSegment(data= data.astype(np.uint8).tobytes(), sample_width=1, frame_rate = self.fs, channels  =1)
         return result
 
 
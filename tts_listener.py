@@ -1,30 +1,276 @@
 import time
+import queue
+import threading
+import collections
 
 import tts
+import audio
 import message
 
 import ipc
+import timing
+import throttle
+import render_pool
 
-server = ipc.Server(ipc.ports['tts'])
-
-
-while True:
-    tts_queue = []
-    for msg in server.recv():
-        try:
-            kind = msg.get('kind', None)
-            if kind == 'stt':
-                tts_message = message.AIMessage(msg['data'])
-                tts_queue.append(tts_message)
-            elif kind == 'chat':
-                tts_message = message.Message(**msg['data'])
-                tts_queue.append(tts_message)
-        except Exception as e:
-            print(f'Unexpected exception processing {message}: {e}')
-    
-    if len(tts_queue) > 0:
-        tts_message = tts_queue.pop(0)
-        tts_message.play()
-    time.sleep(0.2)
-
-server.close()
\ No newline at end of file
+tracer = timing.Tracer()
+gate = throttle.ChatGate()
+
+def handle(server, msg, tts_queue):
+    """
+    Turn a received message into something playable on the queue, or answer
+    it if it's a request
+    """
+    kind = msg.get('kind', None)
+    trace = msg['trace']
+    trace_id = trace.get('id', None)
+    if kind in ('stt', 'chat', 'audio') and 'sent' in trace: #Only messages that get played, not stats requests
+        tracer.record(trace_id, 'queue', trace['received']-trace['sent'])
+
+    if kind == 'stt':
+        with tracer.span(trace_id, 'construct'):
+            tts_message = message.AIMessage(msg['data'])
+        tts_queue.append((trace, tts_message))
+    elif kind == 'chat':
+        data = msg['data']
+        exempt = message.User(data['msg'], data['tags']).get_class('mod')
+        if not gate.allow(data, exempt): return
+        with tracer.span(trace_id, 'construct'):
+            tts_message = message.Message(**data)
+        tts_queue.append((trace, tts_message))
+    elif kind == 'audio':
+        with tracer.span(trace_id, 'construct'):
+            tts_message = message.ClipMessage(audio.to_canonical(ipc.to_segment(msg)))
+        tts_queue.append((trace, tts_message))
+    elif kind == 'stats':
+        server.reply(msg, {
+            'latency': tracer.summary(),
+            'cache': tts.TTS.cache.get_stats(),
+            'audio': audio.get_stats(),
+            'queue': dict(scheduler.get_stats(), speed=pacer.speed),
+            'gate': gate.get_stats(),
+            })
+
+class Scheduler():
+    """
+    Messages waiting to be rendered, in one queue per class of message. get
+    returns the head of the queue with the highest base priority plus aging
+    times how long it's been waiting, so stt and mods go first but regular
+    chat still gets its turn during a steady stream of them. Messages that
+    have waited longer than their class's max_wait are dropped instead of
+    being read late, and each queue holds at most max_depth messages, so a
+    flood drops the oldest of its own class rather than growing the queue.
+    """
+    #Base priority per class, in seconds of waiting. A chat message that has
+    #waited 10 seconds longer than a mod message goes first.
+    priorities = {'stt': 30, 'audio': 30, 'mod': 10, 'sub': 5, 'chat': 0}
+    aging = 1
+    max_wait = {'sub': 60, 'chat': 30} #seconds, classes not listed are never dropped
+    max_depth = 20 #per class
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {x: collections.deque() for x in self.priorities} #class: (trace, message, enqueued, estimate)
+        self.backlog = 0 #estimated seconds of speech waiting
+        self.scheduled = {x: 0 for x in self.priorities}
+        self.dropped = {x: 0 for x in self.priorities}
+
+    def classify(self, tts_message):
+        if isinstance(tts_message, message.AIMessage): return 'stt'
+        if isinstance(tts_message, message.ClipMessage): return 'audio'
+        user = getattr(tts_message, 'user', None)
+        if user is not None:
+            if user.get_class('mod'): return 'mod'
+            if user.get_class('sub'): return 'sub'
+        return 'chat'
+
+    def put(self, trace, tts_message):
+        kind = self.classify(tts_message)
+        estimate = tts_message.estimate_duration()
+        with self.condition:
+            waiting = self.queues[kind]
+            if len(waiting) >= self.max_depth:
+                self.backlog -= waiting.popleft()[3]
+                self.dropped[kind] += 1
+            waiting.append((trace, tts_message, time.monotonic(), estimate))
+            self.backlog += estimate
+            self.condition.notify()
+
+    def get(self):
+        """
+        Wait for the next message to render and return (trace, message)
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.drop_stale(now)
+                kind = self.pick(now)
+                if kind is not None: break
+                self.condition.wait()
+            trace, tts_message, enqueued, estimate = self.queues[kind].popleft()
+            self.backlog -= estimate
+            self.scheduled[kind] += 1
+        trace_id = trace.get('id', None)
+        tracer.record(trace_id, 'wait', now-enqueued)
+        tracer.record(trace_id, f'wait:{kind}', now-enqueued)
+        return trace, tts_message
+
+    def pick(self, now):
+        best = None
+        best_priority = None
+        for kind, waiting in self.queues.items():
+            if len(waiting) == 0: continue
+            priority = self.priorities[kind] + self.aging*(now-waiting[0][2])
+            if best is None or priority > best_priority:
+                best = kind
+                best_priority = priority
+        return best
+
+    def drop_stale(self, now):
+        for kind, max_wait in self.max_wait.items():
+            waiting = self.queues[kind]
+            while len(waiting) > 0 and now-waiting[0][2] > max_wait:
+                self.backlog -= waiting.popleft()[3]
+                self.dropped[kind] += 1
+
+    def get_depth(self):
+        """
+        How many messages are waiting, and about how many seconds of speech
+        """
+        with self.condition:
+            return sum(len(x) for x in self.queues.values()), max(0, self.backlog)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                'backlog': max(0, self.backlog),
+                'depth': {k: len(v) for k, v in self.queues.items()},
+                'scheduled': dict(self.scheduled),
+                'dropped': dict(self.dropped),
+                }
+
+scheduler = Scheduler()
+
+class Pacer():
+    """
+    Picks how much faster to read as the backlog grows, so it can be caught
+    up on without dropping anything. curve is (backlog seconds, speed)
+    points with straight lines in between, flat past either end. By default
+    it's built from target, the latency to aim for: normal speed up to
+    target seconds of backlog, then fast enough that the backlog takes about
+    target seconds to read, up to max_speed. That tops out at
+    target*max_speed seconds of backlog, which should stay under the
+    smallest Scheduler.max_wait so messages speed up before they're dropped.
+    Speeds are rounded to step so renders at the same speed share the render
+    cache.
+    """
+    target = 10 #seconds
+    max_speed = 2
+    curve = None #Built from target and max_speed unless set
+    depth_curve = [(0, 1)] #(queue depth, speed), for backlogs that are many short messages
+    step = 0.1
+
+    def __init__(self):
+        self.speed = 1
+        if self.curve is None:
+            self.curve = [(0, 1), (self.target, 1), (self.target*self.max_speed, self.max_speed)]
+
+    def interpolate(self, curve, x):
+        if x <= curve[0][0]: return curve[0][1]
+        for (x0, y0), (x1, y1) in zip(curve, curve[1:]):
+            if x <= x1:
+                return y0 + (y1-y0)*(x-x0)/(x1-x0)
+        return curve[-1][1]
+
+    def update(self, depth, backlog):
+        speed = max(self.interpolate(self.curve, backlog), self.interpolate(self.depth_curve, depth))
+        self.speed = round(round(speed/self.step)*self.step, 3)
+        return self.speed
+
+pacer = Pacer()
+
+class Pipeline():
+    """
+    Renders the next few messages in the background while the current one
+    plays, so back-to-back messages play without waiting on rendering.
+    Messages wait in a Scheduler until it's their turn to render, the Pacer
+    picks how fast they're read from what's still waiting, and depth is how
+    many rendered clips can wait to be played.
+    """
+    def __init__(self, depth = 2):
+        self.scheduler = scheduler
+        self.pacer = pacer
+        #Who the last chat message to play was from, or None after anything
+        #else, like stt or a repeat count. Clips play in the order they're rendered, so this decides
+        #whether to read the speaker's name, not the sender's history, which
+        #includes messages that were gated, dropped or reordered here.
+        self.last_user = None
+        self.ready = queue.Queue(maxsize = depth)
+        self.threads = [
+            threading.Thread(target=self.render_loop, daemon=True),
+            threading.Thread(target=self.play_loop, daemon=True),
+            ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, trace, tts_message):
+        self.scheduler.put(trace, tts_message)
+
+    def render_loop(self):
+        while True:
+            trace, tts_message = self.scheduler.get()
+            tts_message.speed = self.pacer.update(*self.scheduler.get_depth())
+            if isinstance(tts_message, message.Message):
+                tts_message.set_past_user(self.last_user)
+            try:
+                clip = tts_message.render()
+            except Exception as e:
+                print(f'Failed to render {tts_message}: {e}')
+                continue
+            if clip is not None:
+                self.last_user = tts_message.user if isinstance(tts_message, message.Message) and tts_message.announce_new_speakers else None
+            self.ready.put((trace, tts_message, clip))
+
+    def play_loop(self):
+        while True:
+            trace, tts_message, clip = self.ready.get()
+            try:
+                tts_message.play_clip(clip)
+            except Exception as e:
+                print(f'Failed to play {tts_message}: {e}')
+                continue
+            trace_id = trace.get('id', None)
+            for stage, seconds in tts_message.timings.items():
+                tracer.record(trace_id, stage, seconds)
+            if 'sent' in trace:
+                tracer.record(trace_id, 'total', time.monotonic()-trace['sent'])
+
+def main():
+    server = ipc.Server(ipc.ports['tts'], hwm = 10)
+
+    pool = render_pool.RenderPool()
+    message.Message.render_pool = pool
+    message.AIMessage.render_pool = pool
+
+    pipeline = Pipeline()
+
+    try:
+        while True:
+            tts_queue = []
+            for msg in server.recv(timeout = 1):
+                try:
+                    handle(server, msg, tts_queue)
+                except Exception as e:
+                    print(f'Unexpected exception processing {msg}: {e}')
+            for data in gate.announcements():
+                tts_message = message.Message(**data)
+                tts_message.announce_new_speakers = False #Not really from whoever sent the first copy
+                tts_queue.append(({}, tts_message))
+
+            for trace, tts_message in tts_queue:
+                pipeline.put(trace, tts_message)
+    finally:
+        pool.close()
+        server.close()
+
+if __name__ == '__main__':
+    main()